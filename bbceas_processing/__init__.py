@@ -1,6 +1,26 @@
+import importlib
+
 from .process import analyze
 
+from . import batch
+from . import calibration
+from . import chunked
+from . import dataset
+from . import downsample
+from . import fitting
+from . import housekeeping
+from . import instruments
+from . import phases
+from . import prepare
+from . import profiling
+from . import stream
 from . import utils
+from . import writers
+
 
-from . import closed_cavity_data
-from . import open_cavity_data
+# The instrument modules are imported on first use, e.g. by
+# instruments.get_instrument() or bbceas_processing.open_cavity_data.
+def __getattr__(name):
+    if name in ("closed_cavity_data", "open_cavity_data"):
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
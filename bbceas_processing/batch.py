@@ -0,0 +1,247 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+import os
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+
+from . import dataset
+from . import instruments
+from . import prepare
+from . import rayleigh
+from . import utils
+from . import writers
+from .process import analyze
+
+SCATTERING = ["N2", "He", "Air"]
+
+
+# Reads a batch manifest: a CSV with a dataset, bounds and (optional) instrument
+# column, one analysis per row. Relative paths are taken from the manifest's folder.
+# Each job's results go to out_folder/<n>-<dataset name>, or to its output column.
+def read_manifest(path, out_folder):
+    path = Path(path)
+    manifest = pd.read_csv(path, dtype=str)
+    missing = {"dataset", "bounds"} - set(manifest.columns)
+    if missing:
+        raise ValueError(f"{path} has no {', '.join(sorted(missing))} column")
+
+    jobs = []
+    for i, row in enumerate(manifest.itertuples(index=False)):
+        row = row._asdict()
+        instrument = row.get("instrument")
+        output = row.get("output")
+        jobs.append(
+            {
+                "dataset": str(path.parent / row["dataset"]),
+                "bounds": str(path.parent / row["bounds"]),
+                "instrument": "closed-cavity" if pd.isna(instrument) else instrument,
+                "output": str(
+                    Path(out_folder) / f"{i}-{Path(row['dataset']).stem}"
+                    if pd.isna(output)
+                    else path.parent / output
+                ),
+            }
+        )
+    return jobs
+
+
+# Runs analyze() for every job on `workers` processes (all CPUs by default). The
+# cross-section matrix and Rayleigh scattering table are computed once per
+# wavelength grid in this process and handed to the workers through shared memory.
+# Each job writes its fit values, errors, absorption and fitted data to its output
+# folder, `window` timestamps at a time, plus its reflectivity. A failing job does
+# not stop the others, even when its worker process dies (e.g. killed for running
+# out of memory): the jobs that had not finished are run again in a new pool. If
+# several jobs were running when the pool broke, each is rerun on its own to find
+# the one that killed it. report, if given, is called with each job's summary as it
+# finishes. Returns the summary of every job (status, spectra, time, spectra/s and
+# the error of failed jobs).
+def run_batch(jobs, cross_section_files, workers=None, window=1000, report=None):
+    summaries = [None] * len(jobs)
+    grids = {}
+    shared = []
+    try:
+        tasks = []
+        for i, job in enumerate(jobs):
+            try:
+                grid = prepare.fit_wavelengths(dataset.wavelengths(job["dataset"]))
+                key = grid.to_numpy(dtype=float).tobytes()
+                if key not in grids:
+                    grids[key] = _share(grid, cross_section_files, shared)
+            except Exception as error:
+                summaries[i] = _summary(job, error=error)
+                if report is not None:
+                    report(summaries[i])
+                continue
+            tasks.append((i, job, grids[key]))
+
+        workers = workers or os.cpu_count() or 1
+        while tasks:
+            again, died = _run_pool(tasks, workers, window, summaries, report)
+            if len(again) == len(tasks):
+                # The pool broke before any job ran.
+                again, died = [], died + again
+            tasks = again
+            if len(died) > 1:
+                died = [
+                    task
+                    for task in died
+                    if any(_run_pool([task], 1, window, summaries, report))
+                ]
+            for i, job, _ in died:
+                summaries[i] = _summary(
+                    job, error=BrokenProcessPool("The worker process died")
+                )
+                if report is not None:
+                    report(summaries[i])
+    finally:
+        for block in shared:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(summaries)
+
+
+# Runs tasks in one process pool, filling in summaries. If a worker process dies,
+# the pool breaks and every job still in it is left without a summary. Returns
+# those jobs split into the ones that had not started or had finished (to run
+# again) and the ones that were running when the pool broke.
+def _run_pool(tasks, workers, window, summaries, report):
+    # The state of each task, set by the workers: 0 waiting, 1 running, 2 done.
+    states = multiprocessing.RawArray("b", len(tasks))
+    unfinished = []
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_set_states, initargs=(states,)
+    ) as pool:
+        futures = [
+            pool.submit(_run_job, job, spec, window, slot)
+            for slot, (_, job, spec) in enumerate(tasks)
+        ]
+        for slot, ((i, job, _), future) in enumerate(zip(tasks, futures)):
+            try:
+                summaries[i] = future.result()
+            except BrokenProcessPool:
+                unfinished.append(slot)
+                continue
+            except Exception as error:
+                summaries[i] = _summary(job, error=error)
+            if report is not None:
+                report(summaries[i])
+
+    again = [tasks[slot] for slot in unfinished if states[slot] != 1]
+    died = [tasks[slot] for slot in unfinished if states[slot] == 1]
+    return again, died
+
+
+# The task states of this worker's pool (see _run_pool).
+_states = None
+
+
+def _set_states(states):
+    global _states
+    _states = states
+
+
+# Puts the wavelengths, the cross-section matrix and the scattering table of a grid
+# side by side in one shared memory block. Returns what a worker needs to read it.
+def _share(grid, cross_section_files, shared):
+    matrix = prepare.cross_section_matrix(cross_section_files, grid)
+    table = rayleigh.scattering_table(grid)
+    values = np.column_stack([grid.to_numpy(dtype=float), matrix, table[SCATTERING]])
+
+    block = shared_memory.SharedMemory(create=True, size=values.nbytes)
+    shared.append(block)
+    np.ndarray(values.shape, buffer=block.buf)[:] = values
+    return {"name": block.name, "shape": values.shape, "gases": matrix.shape[1]}
+
+
+# Shared memory blocks this worker process has attached, by name. They stay attached
+# for the life of the process, since the cached arrays point into them.
+_attached = {}
+
+
+def _attach(spec):
+    if spec["name"] not in _attached:
+        block = _open_shared(spec["name"])
+        values = np.ndarray(spec["shape"], buffer=block.buf)
+        values.flags.writeable = False
+        _attached[spec["name"]] = (block, values)
+    return _attached[spec["name"]][1]
+
+
+# Attaches to a block the parent created without registering it with the resource
+# tracker. The parent owns and unlinks it; a worker's registration would make the
+# tracker unlink it again or report it as leaked. Before Python 3.13 attaching
+# always registers, and unregistering afterwards would drop the parent's entry from
+# a tracker they share, so registration is switched off while attaching.
+def _open_shared(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _run_job(job, spec, window, slot=None):
+    if slot is not None:
+        _states[slot] = 1
+    start = time.perf_counter()
+    try:
+        values = _attach(spec)
+        grid = pd.Index(values[:, 0])
+        gases = spec["gases"]
+        cross_sections = pd.DataFrame(values[:, 1 : 1 + gases], index=grid)
+        rayleigh.preload(
+            pd.DataFrame(values[:, 1 + gases :], index=grid, columns=SCATTERING)
+        )
+
+        with open(job["bounds"]) as f:
+            bounds = json.load(f)
+        begin, end = utils.bounds_span(bounds)
+        samples = dataset.load(
+            job["dataset"], start=begin, end=end, low=grid[0], high=grid[-1]
+        )
+
+        output = Path(job["output"])
+        processed_data = analyze(
+            samples,
+            bounds,
+            cross_sections,
+            instruments.get_instrument(job["instrument"]),
+            writer=writers.CsvWriter(output),
+            window=window,
+        )
+        processed_data["reflectivity"].to_csv(output / "reflectivity.csv")
+        n_spectra = len(processed_data["fit_curve_values"])
+    except Exception as error:
+        summary = _summary(job, error=error)
+    else:
+        summary = _summary(job, n_spectra, time.perf_counter() - start)
+
+    if slot is not None:
+        _states[slot] = 2
+    return summary
+
+
+def _summary(job, n_spectra=0, seconds=np.nan, error=None):
+    return {
+        "dataset": job["dataset"],
+        "output": job["output"],
+        "status": "ok" if error is None else "failed",
+        "spectra": n_spectra,
+        "seconds": seconds,
+        "spectra_per_s": n_spectra / seconds if n_spectra else np.nan,
+        "error": None if error is None else f"{type(error).__name__}: {error}",
+    }
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import utils
+
+DEFAULT_FOLDER = Path.home() / ".cache" / "bbceas_processing" / "calibrations"
+
+
+# On-disk cache of instrument calibrations (the result of
+# instrument.get_calibration(), see process.analyze). Entries are keyed by key() and
+# the least recently used ones are removed once the cache grows past max_size bytes.
+# Calibrations can also be saved under a name with save() so that other datasets can
+# reference them with load(); named calibrations are never evicted.
+class CalibrationCache:
+    def __init__(self, folder=DEFAULT_FOLDER, max_size=256 * 1024**2):
+        self.folder = Path(folder)
+        self.max_size = max_size
+        (self.folder / "named").mkdir(parents=True, exist_ok=True)
+
+    # Hash of the dataset identity, the calibration windows (everything but target),
+    # the wavelength grid, the instrument type and its options.
+    def key(self, in_data, bounds, wavelengths, instrument_type, options=None):
+        windows = utils.parse_bounds(
+            {key: value for key, value in bounds.items() if key != "target"}
+        )
+        content = {
+            "dataset": dataset_identity(in_data),
+            "bounds": {
+                key: [[str(start), str(end)] for start, end in pairs]
+                for key, pairs in sorted(windows.items())
+            },
+            "wavelengths": hashlib.sha256(
+                np.asarray(wavelengths, dtype=float).tobytes()
+            ).hexdigest(),
+            "instrument": instrument_type,
+        }
+        if options:
+            content["options"] = options
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+    def get(self, key):
+        path = self.folder / f"{key}.pkl"
+        if not path.exists():
+            return None
+        # Mark the entry as recently used.
+        os.utime(path)
+        return pd.read_pickle(path)
+
+    def put(self, key, calibration):
+        pd.to_pickle(calibration, self.folder / f"{key}.pkl")
+        self._evict()
+
+    def save(self, name, calibration):
+        pd.to_pickle(calibration, self.folder / "named" / f"{name}.pkl")
+
+    def load(self, name):
+        path = self.folder / "named" / f"{name}.pkl"
+        if not path.exists():
+            raise KeyError(f"No calibration named {name}")
+        return pd.read_pickle(path)
+
+    def _evict(self):
+        entries = sorted(
+            self.folder.glob("*.pkl"), key=lambda path: path.stat().st_mtime
+        )
+        size = sum(path.stat().st_size for path in entries)
+        while entries and size > self.max_size:
+            path = entries.pop(0)
+            size -= path.stat().st_size
+            path.unlink()
+
+
+# Identifies a dataset file or folder by its path and the size and modification
+# time of every file in it, so the key changes whenever the data does.
+def dataset_identity(in_data):
+    path = Path(in_data).resolve()
+    if path.is_dir():
+        files = sorted(file for file in path.rglob("*") if file.is_file())
+    else:
+        files = [path]
+
+    identity = [str(path)]
+    for file in files:
+        stat = file.stat()
+        identity.append([str(file), stat.st_size, stat.st_mtime_ns])
+    return identity
@@ -0,0 +1,134 @@
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from . import dataset
+from . import prepare
+from . import stream
+from . import utils
+
+
+# Out-of-core version of process.analyze for datasets that do not fit in memory.
+# The calibration windows are read and reduced once, then the target window is read
+# from the dataset at in_data and fitted `chunk` (a time span such as "1h") at a
+# time. Each chunk's absorption, fitted data and fit values go to writer.write() as
+# soon as they are done, so peak memory depends on the chunk size and not on the
+# length of the dataset. Only the per-timestamp fit values and the spectra with the
+# highest concentration are returned. average co-adds the target spectra into bins
+# of that time span before fitting, as in process.analyze.
+def analyze_chunked(
+    in_data, bounds, cross_sections, instrument, writer, chunk="1h", average=None
+):
+    calibration_bounds = {
+        key: value for key, value in bounds.items() if key != "target"
+    }
+    # Only the wavelengths of the fit window are read.
+    wavelengths = prepare.fit_wavelengths(dataset.wavelengths(in_data))
+    low, high = wavelengths[0], wavelengths[-1]
+
+    samples = _calibration_samples(in_data, calibration_bounds, low, high)
+    analyzer = stream.StreamAnalyzer(
+        samples, calibration_bounds, cross_sections, instrument
+    )
+    del samples
+
+    values, errors = [], []
+    counts, stds = [], []
+    highest = None
+    chunks = _target_chunks(in_data, bounds, pd.Timedelta(chunk), low, high)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("No target spectra in bounds")
+    chunks = chain([first], chunks)
+    if average is not None:
+        chunks = _whole_bins(chunks, pd.Timedelta(average))
+    for data in chunks:
+        if average is not None:
+            data, count, std = utils.coadd(data, average)
+            counts.append(count)
+            stds.append(std)
+        results = analyzer.fit(data.index, data.to_numpy())
+        del data
+        writer.write(results)
+        values.append(results["fit_curve_values"])
+        errors.append(results["fit_curve_errors"])
+
+        concentrations = results["fit_curve_values"][0].to_numpy()
+        if not np.isnan(concentrations).all():
+            best = np.nanargmax(concentrations)
+            if highest is None or concentrations[best] > highest[0]:
+                highest = (
+                    concentrations[best],
+                    results["absorption"].iloc[best],
+                    results["fit_data"].iloc[best],
+                )
+
+    if highest is None:
+        # No spectrum had a finite fit.
+        absorption_highest = pd.Series(np.nan, index=analyzer.wavelengths)
+        fit_data_highest = pd.Series(np.nan, index=analyzer.wavelengths)
+    else:
+        _, absorption_highest, fit_data_highest = highest
+    return {
+        "samples": None,
+        "reflectivity": analyzer.reflectivity,
+        "absorption_all": None,
+        "absorption_highest": absorption_highest,
+        "cross_sections_target": analyzer.cross_sections[0],
+        "fit_data_all": None,
+        "fit_data_highest": fit_data_highest,
+        "fit_curve_values": pd.concat(values),
+        "fit_curve_errors": pd.concat(errors),
+        "residuals_all": None,
+        "residuals_highest": fit_data_highest - absorption_highest,
+        "coadd_counts": pd.concat(counts) if counts else None,
+        "coadd_std": pd.concat(stds) if stds else None,
+    }
+
+
+# The rows of every calibration window, each read on its own so that the time
+# between windows (e.g. a target period between two calibrations) is never read.
+def _calibration_samples(in_data, bounds, low, high):
+    windows = sorted(
+        set(pair for pairs in utils.parse_bounds(bounds).values() for pair in pairs)
+    )
+    samples = pd.concat(
+        [
+            dataset.load(in_data, start=start, end=end, low=low, high=high)
+            for start, end in windows
+        ]
+    )
+    # Overlapping windows would read some rows twice.
+    return samples[~samples.index.duplicated()].sort_index()
+
+
+# Yields the rows of every target window, at most `chunk` of time at once. Like
+# bound_samples, the windows exclude their end points.
+def _target_chunks(in_data, bounds, chunk, low, high):
+    for start, end in utils.parse_bounds(bounds)["target"]:
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk, end)
+            data = dataset.load(
+                in_data, start=chunk_start, end=chunk_end, low=low, high=high
+            )
+            data = data[(data.index > start) & (data.index < chunk_end)]
+            chunk_start = chunk_end
+            if not data.empty:
+                yield data
+
+
+# Regroups chunks of rows so that no bin of `period` is split between two of them.
+def _whole_bins(chunks, period):
+    pending = None
+    for data in chunks:
+        if pending is not None:
+            data = pd.concat([pending, data])
+        labels = data.index.floor(period)
+        last = labels == labels[-1]
+        pending = data[last]
+        if not last.all():
+            yield data[~last]
+    if pending is not None:
+        yield pending
@@ -1,35 +1,124 @@
-import arrow
+import numpy as np
+import pandas as pd
 
+from . import housekeeping
 from . import rayleigh
+from . import utils
 
 
 CAVITY_LENGTH = 96.6
 
 
+# With time_resolved, every dark, N2 and He window is reduced to its own spectrum
+# instead of all windows of a key being averaged together. The reflectivity is then
+# computed at each N2 window (with He and dark interpolated to it), and the dark,
+# N2 reference and reflectivity are interpolated in time onto every target
+# timestamp, so one run covers a deployment with repeated calibrations while the
+# mirrors drift.
+# Gas densities are fixed (620 Torr, 298 K) unless a housekeeping log is given with
+# set_housekeeping().
 class ClosedCavityData:
     bound_params = ["dark", "N2", "He", "target"]
+    calibration_params = ["dark", "N2", "He"]
+    # The calibration keys from the least to the most light through the cavity, for
+    # phases.detect_phases().
+    phase_levels = ["dark", "N2", "He"]
+
+    def __init__(self, time_resolved=False):
+        self.time_resolved = time_resolved
+        self.housekeeping = None
+        self.tolerance = None
+        self.calibration_densities = None
+
+    # Takes the gas densities from a housekeeping log (see
+    # housekeeping.read_housekeeping): the mean density over the N2 and He windows
+    # for the reflectivity, and the density at every target timestamp for the
+    # absorption. tolerance is how far the nearest record may be from a spectrum.
+    def set_housekeeping(self, log, tolerance=None):
+        self.housekeeping = log
+        self.tolerance = tolerance
 
     def bound_samples(self, samples, bounds):
-        bounds_data = {}
-        for key, value in bounds.items():
-            bounds_data[key] = samples[
-                (
-                    (samples.index > arrow.get(value[0]).datetime)
-                    & (samples.index < arrow.get(value[1]).datetime)
-                )
-            ]
-
-        # Take the mean of wavelengths over time for N2 and He and subtract the darkcounts from each N2, He, and the target samples
-        self.bounded_samples = {
-            "N2": bounds_data["N2"].mean(axis=0) - bounds_data["dark"].mean(axis=0),
-            "He": bounds_data["He"].mean(axis=0) - bounds_data["dark"].mean(axis=0),
-            "target": bounds_data["target"].sub(
-                bounds_data["dark"].mean(axis=0), axis=1
-            ),
-        }
+        # Each key can have several windows (e.g. repeated dark measurements).
+        bounds_data = utils.bound_windows(samples, bounds)
+
+        self.calibration_densities = None
+        if self.housekeeping is not None:
+            self.calibration_densities = {
+                key: self._calibration_density(bounds_data[key]) for key in ["N2", "He"]
+            }
+
+        if self.time_resolved:
+            self.bounded_samples = self._bound_calibrations(bounds_data)
+            dark = self.bounded_samples["dark"]
+        else:
+            # Take the mean of wavelengths over time for N2 and He and subtract the darkcounts from each N2, He, and the target samples
+            dark = utils.windows_mean(bounds_data["dark"])
+            self.bounded_samples = {
+                "dark": dark,
+                "N2": utils.windows_mean(bounds_data["N2"]) - dark,
+                "He": utils.windows_mean(bounds_data["He"]) - dark,
+            }
+        # The target window is optional when only calibrating (e.g. for streaming).
+        if "target" in bounds_data:
+            target = utils.windows_concat(bounds_data["target"])
+            self.bounded_samples["target"] = utils.subtract_dark(target, dark)
 
         return self.bounded_samples
 
+    # One dark-corrected spectrum per calibration window, indexed by time, each
+    # corrected with the dark interpolated to its own time.
+    def _bound_calibrations(self, bounds_data):
+        dark = utils.windows_means(bounds_data["dark"])
+        calibrations = {"dark": dark}
+        for key in ["N2", "He"]:
+            means = utils.windows_means(bounds_data[key])
+            calibrations[key] = utils.subtract_dark(means, dark)
+        return calibrations
+
+    # The mean density over the windows, or with time_resolved over each window
+    # (indexed like the spectra of _bound_calibrations).
+    def _calibration_density(self, windows):
+        frames = housekeeping.window_densities(
+            self.housekeeping, windows, self.tolerance
+        )
+        if self.time_resolved:
+            return utils.windows_means(frames)["density"]
+        return utils.windows_mean(frames)["density"]
+
+    # Density of the sampled gas at each of times, as a column that scales every
+    # spectrum, or the fixed density without a housekeeping log.
+    def _target_density(self, times):
+        if self.housekeeping is None:
+            return self.N2_dens
+        return housekeeping.densities(self.housekeeping, times, self.tolerance)[:, None]
+
+    # Bounds only the target window, using the dark spectrum of a calibration loaded
+    # with set_calibration().
+    def bound_target(self, samples, bounds):
+        windows = utils.bound_windows(samples, {"target": bounds["target"]})
+        target = utils.windows_concat(windows["target"])
+        dark = self.bounded_samples["dark"]
+        self.bounded_samples["target"] = utils.subtract_dark(target, dark)
+        return self.bounded_samples
+
+    # The bounded calibration spectra and reflectivity, to be cached and reused.
+    def get_calibration(self):
+        calibration = {
+            key: self.bounded_samples[key] for key in self.calibration_params
+        }
+        calibration["reflectivity"] = self.reflectivity
+        return calibration
+
+    # Replaces bound_samples() (for the calibration windows) and get_reflectivity().
+    def set_calibration(self, calibration):
+        self._get_densities()
+        self.bounded_samples = {
+            key: calibration[key] for key in self.calibration_params
+        }
+        self.reflectivity = calibration["reflectivity"]
+        return self.reflectivity
+
     def _get_densities(self):
         # find density of the gasses
         self.N2_dens = rayleigh.Density_calc(pressure=620, temp_K=298)
@@ -39,19 +128,38 @@ class ClosedCavityData:
         return {"N2": self.N2_dens, "He": self.He_dens, "target": self.target_dens}
 
     # TODO: consider consolodating the next four functions
+    # A reflectivity spectrum, or with time_resolved a DataFrame of one per N2
+    # window, indexed by the window's time.
     def get_reflectivity(self, samples):
         self._get_densities()
+        N2 = self.bounded_samples["N2"]
+        He = self.bounded_samples["He"]
+        density_N2, density_He = self.N2_dens, self.He_dens
+        if self.calibration_densities is not None:
+            density_N2 = self.calibration_densities["N2"]
+            density_He = self.calibration_densities["He"]
+        if isinstance(N2, pd.DataFrame):
+            He = pd.DataFrame(
+                utils.interpolate_rows(He, N2.index), index=N2.index, columns=N2.columns
+            )
+            if isinstance(density_He, pd.Series):
+                # One density per N2 window, as a column.
+                density_He = utils.interpolate_rows(density_He.to_frame(), N2.index)
+                density_N2 = density_N2.to_numpy()[:, None]
         self.reflectivity = self._reflectivity_single(
             d0=CAVITY_LENGTH,
             wl=samples.columns,
-            He=self.bounded_samples["He"],
-            N2=self.bounded_samples["N2"],
-            density_N2=self.N2_dens,
-            density_He=self.He_dens,
+            He=He,
+            N2=N2,
+            density_N2=density_N2,
+            density_He=density_He,
         )
         return self.reflectivity
 
     def get_absorption(self, index, reflectivity):
+        if isinstance(reflectivity, pd.DataFrame) or self.housekeeping is not None:
+            target = self.bounded_samples["target"].loc[[index]]
+            return self.get_absorption_all(reflectivity, target=target).iloc[0]
         absorb = self._calculate_alpha(
             d0=CAVITY_LENGTH,
             Reflectivity=reflectivity,
@@ -62,6 +170,30 @@ class ClosedCavityData:
         )
         return absorb
 
+    # Same as get_absorption, but for every target timestamp in `rows` at once.
+    # target optionally replaces the bounded target window with other dark-corrected
+    # spectra. A time-resolved reflectivity and N2 reference are interpolated onto
+    # the target timestamps.
+    def get_absorption_all(self, reflectivity, rows=slice(None), target=None):
+        if target is None:
+            target = self.bounded_samples["target"]
+        target = target.iloc[rows]
+        Ref = self.bounded_samples["N2"]
+        if isinstance(reflectivity, pd.DataFrame):
+            reflectivity = utils.interpolate_rows(reflectivity, target.index)
+            Ref = utils.interpolate_rows(Ref, target.index)
+        extinction = self._extinction(
+            d0=CAVITY_LENGTH,
+            Reflectivity=np.asarray(reflectivity),
+            wl=target.columns,
+            density_gas=self._target_density(target.index),
+        )
+        Ref = np.asarray(Ref)
+        Spec = target.to_numpy()
+        alpha = np.asarray(extinction) * ((Ref - Spec) / Spec)
+
+        return pd.DataFrame(alpha, index=target.index, columns=target.columns)
+
     def _reflectivity_single(self, d0, wl, He, N2, density_N2, density_He):
         Scat_He = rayleigh.Rayleigh_He(wl)
         Scat_N2 = rayleigh.Rayleigh_N2(wl)
@@ -73,9 +205,12 @@ class ClosedCavityData:
         return Reflectivity
 
     def _calculate_alpha(self, d0, Reflectivity, Ref, Spec, wl, density_gas):
-        Scat_Air = rayleigh.Rayleigh_Air(wl)
-        alpha = ((1 - Reflectivity) / d0 + density_gas * Scat_Air) * (
+        alpha = self._extinction(d0, Reflectivity, wl, density_gas) * (
             (Ref - Spec) / Spec
         )
 
         return alpha
+
+    def _extinction(self, d0, Reflectivity, wl, density_gas):
+        Scat_Air = rayleigh.Rayleigh_Air(wl)
+        return (1 - Reflectivity) / d0 + density_gas * Scat_Air
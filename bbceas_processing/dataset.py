@@ -0,0 +1,249 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import utils
+
+MANIFEST = "manifest.csv"
+WAVELENGTHS = "wavelengths.npy"
+TIMESTAMPS = "timestamps.npy"
+INTENSITIES = "intensities.npy"
+DTYPE = np.float32
+
+
+# An imported dataset is a folder holding the wavelength axis (wavelengths.npy) and
+# one or more parts. Each part is a folder with its sorted timestamps (timestamps.npy,
+# datetime64[ns] UTC) and a contiguous intensity matrix (intensities.npy, timestamps x
+# wavelengths) that is memory-mapped when read, so a query only reads the rows and
+# columns it asks for. Folders built by import_asc_incremental() also keep a manifest
+# of every ingested .asc file (path, size, mtime in ns, timestamp and the part holding
+# its spectrum); each run only ever adds a part, so existing data is not rewritten.
+# Intensities are stored as float32 by default, which holds detector counts
+# exactly enough and halves the size of a dataset; parts keep the dtype they were
+# written with. Pickled DataFrames from the original `import` are still accepted.
+#
+# start/end select a time range and low/high a wavelength range (both inclusive).
+# dtype, if given, converts the intensities (e.g. float64 datasets to float32).
+def load(path, start=None, end=None, low=None, high=None, dtype=None):
+    data = _load(path, start, end, low, high)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+
+def _load(path, start, end, low, high):
+    path = Path(path)
+    if not path.is_dir():
+        return _select(pd.read_pickle(path), start, end, low, high)
+
+    wavelengths = np.load(path / WAVELENGTHS)
+    columns = slice(
+        None if low is None else np.searchsorted(wavelengths, low, "left"),
+        None if high is None else np.searchsorted(wavelengths, high, "right"),
+    )
+
+    manifest = read_manifest(path)
+    if len(manifest):
+        manifest = manifest[manifest["part"].notna()]
+        parts = manifest.groupby("part")["timestamp"]
+    else:
+        parts = [(part.name, None) for part in sorted(path.glob("part-*"))]
+
+    frames = []
+    for part, timestamps in parts:
+        data = _read_part(path / part, wavelengths, start, end, columns)
+        if timestamps is not None:
+            # A part can hold spectra that were later re-imported into a newer part.
+            data = data[data.index.isin(timestamps)]
+        frames.append(data)
+
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames).sort_index()
+
+
+# The wavelength axis of a dataset, without reading its intensities (except for
+# legacy pickles, which have to be read whole).
+def wavelengths(path):
+    path = Path(path)
+    if not path.is_dir():
+        return pd.read_pickle(path).columns
+    return pd.Index(np.load(path / WAVELENGTHS))
+
+
+# Writes data (timestamps x wavelengths) as a single-part dataset folder.
+def write(data, path, dtype=DTYPE):
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / WAVELENGTHS, data.columns.to_numpy(dtype=float))
+    _write_part(data, path / "part-00000", dtype)
+
+
+def _write_part(data, path, dtype):
+    path.mkdir(parents=True, exist_ok=True)
+    data = data.sort_index()
+    np.save(path / TIMESTAMPS, _to_datetime64(data.index))
+    np.save(path / INTENSITIES, np.ascontiguousarray(data.to_numpy(dtype=dtype)))
+
+
+def _read_part(path, wavelengths, start, end, columns):
+    timestamps = np.load(path / TIMESTAMPS)
+    rows = slice(
+        None if start is None else np.searchsorted(timestamps, _to_datetime64(start)),
+        (
+            None
+            if end is None
+            else np.searchsorted(timestamps, _to_datetime64(end), "right")
+        ),
+    )
+    intensities = np.load(path / INTENSITIES, mmap_mode="r")
+
+    return pd.DataFrame(
+        intensities[rows, columns],
+        index=pd.DatetimeIndex(timestamps[rows]).tz_localize("UTC"),
+        columns=wavelengths[columns],
+    )
+
+
+def _select(data, start, end, low, high):
+    if start is not None or end is not None:
+        data = data.sort_index()
+        index = pd.to_datetime(data.index, utc=True)
+        data = data[
+            (start is None or index >= pd.Timestamp(_to_datetime64(start), tz="UTC"))
+            & (end is None or index <= pd.Timestamp(_to_datetime64(end), tz="UTC"))
+        ]
+    if low is not None or high is not None:
+        wavelengths = data.columns
+        data = data.loc[
+            :,
+            (low is None or wavelengths >= low) & (high is None or wavelengths <= high),
+        ]
+    return data
+
+
+# Converts timestamps (naive ones are taken as UTC) to UTC datetime64[ns].
+def _to_datetime64(timestamps):
+    timestamps = pd.to_datetime(timestamps, utc=True)
+    if isinstance(timestamps, pd.Timestamp):
+        return timestamps.tz_localize(None).to_datetime64().astype("datetime64[ns]")
+    return timestamps.tz_localize(None).to_numpy(dtype="datetime64[ns]")
+
+
+def read_manifest(path):
+    manifest_path = Path(path) / MANIFEST
+    if not manifest_path.exists():
+        return pd.DataFrame(columns=["path", "size", "mtime", "timestamp", "part"])
+
+    # Spectra of parts written by write() have no source file, size or mtime.
+    manifest = pd.read_csv(manifest_path, dtype={"size": "Int64", "mtime": "Int64"})
+    manifest["timestamp"] = pd.to_datetime(manifest["timestamp"], utc=True)
+    return manifest
+
+
+# The .asc files in in_folder that are new or changed (by size or mtime) since they
+# were last imported into the dataset folder out_folder, as (file, resolved path,
+# stat) tuples.
+def changed_files(in_folder, out_folder):
+    known = read_manifest(Path(out_folder)).set_index("path")
+    files = []
+    for file in sorted(Path(in_folder).iterdir()):
+        if file.suffix != ".asc":
+            continue
+        stat = file.stat()
+        path = str(file.resolve())
+        if (
+            path not in known.index
+            or known.at[path, "size"] != stat.st_size
+            or known.at[path, "mtime"] != stat.st_mtime_ns
+        ):
+            files.append((file, path, stat))
+    return files
+
+
+# Parses only the .asc files in in_folder that are new or changed (by size or mtime)
+# since the last run and appends them to the dataset folder as a new part. Spectra
+# whose timestamp is already in the dataset, or appears twice in this run, are
+# left out and returned; when all of them are, no part is written. files, if given,
+# is the result of changed_files() (e.g. to size a progress bar). Returns the number
+# of files read and the duplicated timestamps.
+def import_asc_incremental(
+    in_folder, out_folder, workers=None, progress=None, dtype=DTYPE, files=None
+):
+    out_folder = Path(out_folder)
+    out_folder.mkdir(parents=True, exist_ok=True)
+    if (out_folder / MANIFEST).exists():
+        manifest = read_manifest(out_folder)
+    else:
+        manifest = _manifest_of_parts(out_folder)
+    if files is None:
+        files = changed_files(in_folder, out_folder)
+
+    if not files:
+        return {"read": 0, "duplicates": []}
+
+    data = utils.read_asc_files(
+        [file for file, _, _ in files], workers, progress, dtype=dtype
+    )
+
+    entries = pd.DataFrame(
+        {
+            "path": [path for _, path, _ in files],
+            "size": [stat.st_size for _, _, stat in files],
+            "mtime": [stat.st_mtime_ns for _, _, stat in files],
+            "timestamp": pd.to_datetime(data.index, utc=True),
+        }
+    )
+
+    # Re-imported (changed) files replace their previous manifest entry.
+    manifest = manifest[~manifest["path"].isin(entries["path"])]
+    ingested = manifest.loc[manifest["part"].notna(), "timestamp"]
+    duplicated = (
+        entries["timestamp"].isin(ingested) | entries["timestamp"].duplicated()
+    ).to_numpy()
+    duplicates = list(entries.loc[duplicated, "timestamp"])
+
+    wavelengths_path = out_folder / WAVELENGTHS
+    if not wavelengths_path.exists():
+        np.save(wavelengths_path, data.columns.to_numpy(dtype=float))
+    elif not np.array_equal(np.load(wavelengths_path), data.columns.to_numpy()):
+        raise ValueError(
+            f"{in_folder} has a different wavelength axis than {out_folder}"
+        )
+
+    if duplicated.all():
+        entries["part"] = None
+    else:
+        part = f"part-{len(list(out_folder.glob('part-*'))):05d}"
+        _write_part(data[~duplicated], out_folder / part, dtype)
+        entries["part"] = part
+        entries.loc[duplicated, "part"] = None
+
+    if len(manifest):
+        entries = pd.concat([manifest, entries])
+    manifest = entries.sort_values("timestamp")
+    manifest.to_csv(out_folder / MANIFEST, index=False)
+
+    return {"read": len(files), "duplicates": duplicates}
+
+
+# Manifest entries for the parts of a folder written by write(), which keeps no
+# manifest, so that a first incremental import into it keeps them in the dataset
+# and checks its spectra against theirs.
+def _manifest_of_parts(folder):
+    entries = [read_manifest(folder)]
+    for part in sorted(folder.glob("part-*")):
+        timestamps = pd.DatetimeIndex(np.load(part / TIMESTAMPS)).tz_localize("UTC")
+        entries.append(
+            pd.DataFrame(
+                {
+                    "path": None,
+                    "size": pd.array([pd.NA] * len(timestamps), dtype="Int64"),
+                    "mtime": pd.array([pd.NA] * len(timestamps), dtype="Int64"),
+                    "timestamp": timestamps,
+                    "part": part.name,
+                }
+            )
+        )
+    return pd.concat(entries, ignore_index=True)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+
+# Positions of the points of values to draw so a line plot looks the same with
+# n_bins pixels across: the first, smallest, largest and last point of each of
+# n_bins equal slices. Fewer than 4 * n_bins values are returned as they are.
+def minmax_indices(values, n_bins):
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n <= 4 * n_bins:
+        return np.arange(n)
+
+    # Pad to n_bins equal bins; padding never wins a min or a max.
+    size = -(-n // n_bins)
+    padded = np.full(n_bins * size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(n_bins, size)
+    starts = np.arange(n_bins) * size
+
+    low = np.where(np.isnan(padded), np.inf, padded).argmin(axis=1)
+    high = np.where(np.isnan(padded), -np.inf, padded).argmax(axis=1)
+    ends = np.minimum(starts + size, n) - 1
+
+    indices = np.concatenate([starts, starts + low, starts + high, ends])
+    return np.unique(indices[indices < n])
+
+
+# Block means of data (timestamps x wavelengths) on a grid of at most n_times x
+# n_wavelengths, for an overview of a whole dataset. The index and columns are the
+# first timestamp and the mean wavelength of each block.
+def overview(data, n_times=500, n_wavelengths=100):
+    values = np.asarray(data, dtype=float)
+    rows = _block_starts(values.shape[0], n_times)
+    columns = _block_starts(values.shape[1], n_wavelengths)
+
+    sums = np.add.reduceat(np.add.reduceat(values, rows, axis=0), columns, axis=1)
+    counts = np.outer(
+        np.diff(np.append(rows, values.shape[0])),
+        np.diff(np.append(columns, values.shape[1])),
+    )
+    wavelengths = np.add.reduceat(data.columns.to_numpy(dtype=float), columns)
+    wavelengths /= np.diff(np.append(columns, values.shape[1]))
+
+    return pd.DataFrame(sums / counts, index=data.index[rows], columns=wavelengths)
+
+
+def _block_starts(n, n_blocks):
+    return np.unique(np.linspace(0, n, min(n, n_blocks), endpoint=False).astype(int))
@@ -0,0 +1,263 @@
+from itertools import combinations
+
+import numpy as np
+
+
+def design_matrix(cross_sections, wavelengths, order=2):
+    # One column per cross-section followed by the polynomial, highest power first
+    # (a, b, c for the default quadratic).
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    columns = [
+        np.asarray(section, dtype=float).reshape(-1) for section in cross_sections
+    ]
+    columns += [wavelengths**power for power in range(order, -1, -1)]
+    return np.column_stack(columns)
+
+
+# Up to this many gases, the spectra whose unconstrained fit has a negative
+# concentration try every smaller set of free concentrations (2^n - 1 solves, each
+# over all of them at once). With more gases they are solved by NNLS instead.
+ENUMERATE_MAX = 3
+
+
+# Solves every spectrum in ydata at once against the linear model used by
+# process.fit_curve_lm, keeping the concentrations non-negative. If stats (a dict)
+# is given, stats["solves"] is set to the number of least-squares solves each
+# spectrum took part in.
+def fit_curves_linear(cross_sections, xdata, ydata, design=None, stats=None):
+    if design is None:
+        design = design_matrix(cross_sections, xdata)
+    ydata = np.atleast_2d(np.asarray(ydata, dtype=float))
+
+    n_conc = len(cross_sections)
+    n_samples = ydata.shape[0]
+    n_params = design.shape[1]
+
+    results = np.full((n_samples, n_params), np.nan)
+    errors = np.full((n_samples, n_params), np.nan)
+    solves = np.ones(n_samples, dtype=int)
+
+    # Spectra whose unconstrained fit is already feasible are settled after the
+    # first solve. Spectra with missing values are left as NaN.
+    coef, stderr, _ = _solve(design, ydata)
+    feasible = (coef[:, :n_conc] >= 0).all(axis=1)
+    results[feasible] = coef[feasible]
+    errors[feasible] = stderr[feasible]
+
+    rows = np.flatnonzero(~feasible & np.isfinite(ydata).all(axis=1))
+    if len(rows) and n_conc <= ENUMERATE_MAX:
+        _clamp_enumerated(design, ydata, rows, n_conc, results, errors, solves)
+    elif len(rows):
+        _clamp_nnls(design, ydata, rows, n_conc, results, errors, solves)
+
+    if stats is not None:
+        stats["solves"] = solves
+
+    fit_data = results @ design.T
+    return fit_data, results, errors
+
+
+# The non-negative optimum is the unconstrained optimum of the model with some
+# concentrations clamped to zero, so try the free sets from largest to smallest and
+# keep the best feasible solution for each of rows.
+def _clamp_enumerated(design, ydata, rows, n_conc, results, errors, solves):
+    polynomial = list(range(n_conc, design.shape[1]))
+    best_rss = np.full(len(rows), np.inf)
+    for n_free in range(n_conc - 1, -1, -1):
+        for free in combinations(range(n_conc), n_free):
+            columns = list(free) + polynomial
+            coef, stderr, rss = _solve(design[:, columns], ydata[rows])
+            solves[rows] += 1
+
+            better = (coef[:, :n_free] >= 0).all(axis=1) & (rss < best_rss)
+            found = rows[better]
+            results[found] = 0.0
+            results[np.ix_(found, columns)] = coef[better]
+            errors[found] = np.nan
+            errors[np.ix_(found, columns)] = stderr[better]
+            best_rss[better] = rss[better]
+
+
+# Active-set NNLS (Lawson-Hanson) for each of rows on the concentrations, with the
+# unconstrained polynomial projected out. The spectra are then grouped by the
+# concentrations that stayed free and refitted on those in one solve per group,
+# which gives the same solution along with its standard errors.
+def _clamp_nnls(design, ydata, rows, n_conc, results, errors, solves):
+    from scipy.optimize import nnls
+
+    scale = np.linalg.norm(design, axis=0)
+    scale[scale == 0] = 1.0
+    scaled = design / scale
+    basis, _ = np.linalg.qr(scaled[:, n_conc:])
+    gases = scaled[:, :n_conc] - basis @ (basis.T @ scaled[:, :n_conc])
+    projected = ydata[rows] - (ydata[rows] @ basis) @ basis.T
+
+    free = np.empty((len(rows), n_conc), dtype=bool)
+    for i, y in enumerate(projected):
+        norm = np.linalg.norm(y) or 1.0
+        free[i] = nnls(gases, y / norm)[0] > 0
+    solves[rows] += 1
+
+    polynomial = list(range(n_conc, design.shape[1]))
+    patterns, groups = np.unique(free, axis=0, return_inverse=True)
+    for group, pattern in enumerate(patterns):
+        members = rows[groups.reshape(-1) == group]
+        columns = list(np.flatnonzero(pattern)) + polynomial
+        coef, stderr, _ = _solve(design[:, columns], ydata[members])
+        solves[members] += 1
+
+        n_free = pattern.sum()
+        coef[:, :n_free] = np.maximum(coef[:, :n_free], 0.0)
+        results[members] = 0.0
+        results[np.ix_(members, columns)] = coef
+        errors[np.ix_(members, columns)] = stderr
+
+
+def _solve(design, ydata):
+    # Scale the columns first; cross-sections (~1e-19) and wavelength**2 (~1e5)
+    # are otherwise too far apart for a well conditioned solve.
+    scale = np.linalg.norm(design, axis=0)
+    scale[scale == 0] = 1.0
+    scaled = design / scale
+
+    coef, _, _, _ = np.linalg.lstsq(scaled, ydata.T, rcond=None)
+    coef = coef.T
+
+    residuals = ydata - coef @ scaled.T
+    rss = np.sum(residuals**2, axis=1)
+
+    dof = max(design.shape[0] - design.shape[1], 1)
+    inv_diag = np.diag(np.linalg.pinv(scaled.T @ scaled))
+    stderr = np.sqrt(np.outer(rss / dof, inv_diag)) / scale
+
+    return coef / scale, stderr, rss
+
+
+# Fits every spectrum in ydata to the linear model with the cross-sections moved
+# along the wavelength axis, sigma(x + shift + stretch * (x - centre)), where the
+# shift (nm) and stretch are fitted with the concentrations and polynomial by
+# nonlinear least squares given an analytic Jacobian. Concentrations are kept
+# non-negative. With warm_start each spectrum starts from the solution of the one
+# before it, which is close while the spectra change slowly; the first starts from
+# initial (fit values of an earlier spectrum) or a linear fit. Returns the fitted
+# data, the fit values (concentrations, the polynomial highest power first, shift
+# and stretch) and their standard errors. If stats (a dict) is given,
+# stats["nfev"] is set to the number of model evaluations each fit took.
+def fit_curves_shift(
+    cross_sections, xdata, ydata, order=2, initial=None, warm_start=True, stats=None
+):
+    from scipy.optimize import least_squares
+
+    model = _ShiftModel(cross_sections, xdata, order)
+    ydata = np.atleast_2d(np.asarray(ydata, dtype=float))
+    n_samples, n_params = ydata.shape[0], model.n_params
+
+    fit_data = np.full(ydata.shape, np.nan)
+    results = np.full((n_samples, n_params), np.nan)
+    errors = np.full((n_samples, n_params), np.nan)
+    evaluations = np.zeros(n_samples, dtype=int)
+
+    lower = np.full(n_params, -np.inf)
+    lower[: model.n_conc] = 0.0
+    start = None if initial is None else np.asarray(initial, dtype=float)
+    for i, y in enumerate(ydata):
+        if not np.isfinite(y).all():
+            continue
+        if start is None or not np.isfinite(start).all():
+            start = model.linear_start(y)
+        start = np.maximum(start, lower)
+
+        # Residuals are weighted to order one, as the solver's tolerances assume.
+        weight = 1 / max(np.sqrt(np.mean(y**2)), np.finfo(float).tiny)
+        # Levenberg-Marquardt takes few steps from a warm start; the bounded
+        # trust-region solver only runs when a concentration comes out negative.
+        fit = least_squares(
+            model.residual,
+            start,
+            jac=model.jacobian,
+            method="lm",
+            x_scale="jac",
+            args=(y, weight),
+        )
+        nfev = fit.nfev
+        if (fit.x < lower).any():
+            fit = least_squares(
+                model.residual,
+                start,
+                jac=model.jacobian,
+                bounds=(lower, np.inf),
+                x_scale="jac",
+                args=(y, weight),
+            )
+            nfev += fit.nfev
+        results[i] = fit.x
+        fit_data[i] = fit.fun / weight + y
+        errors[i] = _standard_errors(fit.jac, fit.fun)
+        evaluations[i] = nfev
+        start = fit.x if warm_start else initial
+
+    if stats is not None:
+        stats["nfev"] = evaluations
+    return fit_data, results, errors
+
+
+# The model of fit_curves_shift. The cross-sections and their slopes are
+# interpolated at the shifted wavelengths once per parameter vector, which the
+# residual and the Jacobian then share.
+class _ShiftModel:
+    def __init__(self, cross_sections, xdata, order):
+        self.x = np.asarray(xdata, dtype=float)
+        self.sections = np.column_stack(
+            [np.asarray(section, dtype=float).reshape(-1) for section in cross_sections]
+        )
+        self.slopes = np.gradient(self.sections, self.x, axis=0)
+        self.offsets = self.x - self.x.mean()
+        self.polynomial = np.column_stack(
+            [self.x**power for power in range(order, -1, -1)]
+        )
+        self.cross_sections = cross_sections
+        self.order = order
+        self.n_conc = self.sections.shape[1]
+        self.n_linear = self.n_conc + order + 1
+        self.n_params = self.n_linear + 2
+        self._key = None
+
+    def linear_start(self, y):
+        design = np.column_stack([self.sections, self.polynomial])
+        _, values, _ = fit_curves_linear(self.cross_sections, self.x, y, design)
+        return np.append(values[0], [0.0, 0.0])
+
+    def _shifted(self, params):
+        key = (params[-2], params[-1])
+        if key != self._key:
+            positions = self.x + params[-2] + params[-1] * self.offsets
+            self._values = np.column_stack(
+                [np.interp(positions, self.x, column) for column in self.sections.T]
+            )
+            self._slopes = np.column_stack(
+                [np.interp(positions, self.x, column) for column in self.slopes.T]
+            )
+            self._key = key
+        return self._values, self._slopes
+
+    def residual(self, params, y, weight):
+        values, _ = self._shifted(params)
+        concentrations = params[: self.n_conc]
+        polynomial = params[self.n_conc : self.n_linear]
+        return (values @ concentrations + self.polynomial @ polynomial - y) * weight
+
+    def jacobian(self, params, y, weight):
+        values, slopes = self._shifted(params)
+        shift = slopes @ params[: self.n_conc]
+        jacobian = [values, self.polynomial, shift, shift * self.offsets]
+        return np.column_stack(jacobian) * weight
+
+
+# Standard errors of the parameters from the Jacobian and residuals at a solution.
+def _standard_errors(jacobian, residuals):
+    scale = np.linalg.norm(jacobian, axis=0)
+    scale[scale == 0] = 1.0
+    scaled = jacobian / scale
+    dof = max(jacobian.shape[0] - jacobian.shape[1], 1)
+    inv_diag = np.diag(np.linalg.pinv(scaled.T @ scaled))
+    return np.sqrt(inv_diag * np.sum(residuals**2) / dof) / scale
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from . import rayleigh
+
+
+# Reads a housekeeping log: a CSV whose first column is the time and that has
+# pressure (Torr) and temperature (K) columns. Returns them indexed by UTC time,
+# sorted.
+def read_housekeeping(path):
+    housekeeping = pd.read_csv(path, index_col=0)
+    missing = {"pressure", "temperature"} - set(housekeeping.columns)
+    if missing:
+        raise ValueError(f"{path} has no {', '.join(sorted(missing))} column")
+    housekeeping.index = pd.to_datetime(housekeeping.index, utc=True)
+    return housekeeping[["pressure", "temperature"]].astype(float).sort_index()
+
+
+# Gas density (molecules/cm^3) at every one of times, from the housekeeping record
+# nearest to it, found with one merge_asof over all times. tolerance (a pandas time
+# span) is the furthest a record may be; a time without one raises a ValueError.
+def densities(housekeeping, times, tolerance=None):
+    times = pd.DatetimeIndex(times)
+    if not housekeeping.index.is_monotonic_increasing:
+        housekeeping = housekeeping.sort_index()
+    records = housekeeping.index
+    if times.tz is None:
+        times = times.tz_localize("UTC")
+    if records.tz is None:
+        records = records.tz_localize("UTC")
+
+    # merge_asof needs both sides sorted on keys of the same unit.
+    times, records = _utc_ns(times), _utc_ns(records)
+    order = np.argsort(times, kind="stable")
+    left = pd.DataFrame({"time": times[order]})
+    right = pd.DataFrame(
+        {
+            "time": records,
+            "pressure": housekeeping["pressure"].to_numpy(),
+            "temperature": housekeeping["temperature"].to_numpy(),
+        }
+    )
+    merged = pd.merge_asof(
+        left,
+        right,
+        on="time",
+        direction="nearest",
+        tolerance=None if tolerance is None else pd.Timedelta(tolerance),
+    )
+
+    pressure = merged["pressure"].to_numpy()
+    missing = np.isnan(pressure).sum()
+    if missing:
+        raise ValueError(f"No housekeeping within {tolerance} of {missing} spectra")
+
+    density = np.empty(len(times))
+    density[order] = rayleigh.Density_calc(
+        pressure=pressure, temp_K=merged["temperature"].to_numpy()
+    )
+    return density
+
+
+# Naive UTC datetime64[ns] values of a tz-aware index, whatever its unit.
+def _utc_ns(index):
+    return index.tz_convert("UTC").tz_localize(None).to_numpy().astype("datetime64[ns]")
+
+
+# The density at every row of each window, as single-column DataFrames that can be
+# reduced like the spectra (utils.windows_mean or utils.windows_means).
+def window_densities(housekeeping, windows, tolerance=None):
+    return [
+        pd.DataFrame(
+            {"density": densities(housekeeping, window.index, tolerance)},
+            index=window.index,
+        )
+        for window in windows
+    ]
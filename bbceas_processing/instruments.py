@@ -0,0 +1,23 @@
+import importlib
+
+# The instrument class of each instrument type, as its module and class name. A
+# module is only imported when its instrument type is first used.
+INSTRUMENTS = {
+    "closed-cavity": ("closed_cavity_data", "ClosedCavityData"),
+    "open-cavity": ("open_cavity_data", "OpenCavityData"),
+}
+
+
+# The class of an instrument type ("closed-cavity" or "open-cavity").
+def instrument_class(instrument_type):
+    try:
+        module, name = INSTRUMENTS[instrument_type]
+    except KeyError:
+        raise ValueError(f"Unknown instrument type: {instrument_type}") from None
+    return getattr(importlib.import_module(f".{module}", __package__), name)
+
+
+# A new instrument object for an instrument type ("closed-cavity" or "open-cavity"),
+# with options passed to its constructor (e.g. time_resolved for a closed cavity).
+def get_instrument(instrument_type, **options):
+    return instrument_class(instrument_type)(**options)
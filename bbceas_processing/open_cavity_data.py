@@ -1,45 +1,80 @@
-import arrow
-from matplotlib.axis import Axis
-from numpy import NaN
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 
+from . import housekeeping
 from . import rayleigh
+from . import utils
 
 CAVITY_LENGTH = 500
 LOSS_OPTIC = 0.02
 from os import path
 
+# The loss of the optic (wavelength in nm, loss) that get_reflectivity() corrects
+# for. It is read the first time it is needed.
+LOSS_OPTIC_FILE = path.join(path.dirname(__file__), "Loss_optic.csv")
+
 
 class OpenCavityData:
 
-    loss_optic = pd.read_csv(
-        path.join(path.dirname(__file__), 'Loss_optic.csv'), header=None, index_col=0
-    )
+    bound_params = ["dark", "ambient", "with-optic", "target"]
+    calibration_params = ["dark", "ambient", "with-optic"]
+    # The calibration keys from the least to the most light through the cavity, for
+    # phases.detect_phases().
+    phase_levels = ["dark", "with-optic", "ambient"]
 
-    bound_params = ["dark", "ambient", "with-optic" "target"]
+    # Without a housekeeping log the gas density is fixed (620 Torr, 298 K).
+    housekeeping = None
+    tolerance = None
 
-    def bound_samples(self, samples, bounds):
+    # Takes the density of the sampled gas at every target timestamp from a
+    # housekeeping log (see housekeeping.read_housekeeping).
+    def set_housekeeping(self, log, tolerance=None):
+        self.housekeeping = log
+        self.tolerance = tolerance
 
-        self.bounds_data = {}
-        for key, value in bounds.items():
-            self.bounds_data[key] = samples[
-                (
-                    (samples.index > arrow.get(value[0]).datetime)
-                    & (samples.index < arrow.get(value[1]).datetime)
-                )
-            ]
+    def bound_samples(self, samples, bounds):
+        # Each key can have several windows (e.g. repeated dark measurements).
+        self.bounds_data = utils.bound_windows(samples, bounds)
 
+        dark = utils.windows_mean(self.bounds_data["dark"])
         self.bounded_samples = {
-            "ambient": self.bounds_data["ambient"].mean(axis=0)
-            - self.bounds_data["dark"].mean(axis=0),
-            "with-optic": self.bounds_data["with-optic"].mean(axis=0)
-            - self.bounds_data["dark"].mean(axis=0),
-            "target": self.bounds_data["target"].sub(
-                self.bounds_data["dark"].mean(axis=0), axis=1
-            ),
+            "dark": dark,
+            "ambient": utils.windows_mean(self.bounds_data["ambient"]) - dark,
+            "with-optic": utils.windows_mean(self.bounds_data["with-optic"]) - dark,
         }
+        # The target window is optional when only calibrating (e.g. for streaming).
+        if "target" in self.bounds_data:
+            target = utils.windows_concat(self.bounds_data["target"])
+            self.bounded_samples["target"] = utils.subtract_dark(target, dark)
+        return self.bounded_samples
+
+    # Bounds only the target window, using the dark spectrum of a calibration loaded
+    # with set_calibration().
+    def bound_target(self, samples, bounds):
+        windows = utils.bound_windows(samples, {"target": bounds["target"]})
+        target = utils.windows_concat(windows["target"])
+        dark = self.bounded_samples["dark"]
+        self.bounded_samples["target"] = utils.subtract_dark(target, dark)
         return self.bounded_samples
 
+    # The bounded calibration spectra and reflectivity, to be cached and reused.
+    def get_calibration(self):
+        calibration = {
+            key: self.bounded_samples[key] for key in self.calibration_params
+        }
+        calibration["reflectivity"] = self.reflectivity
+        return calibration
+
+    # Replaces bound_samples() (for the calibration windows) and get_reflectivity().
+    def set_calibration(self, calibration):
+        self.bounded_samples = {
+            key: calibration[key] for key in self.calibration_params
+        }
+        self.reflectivity = calibration["reflectivity"]
+        return self.reflectivity
+
     def get_reflectivity(self, samples=None):
         # Target instead here should be ambient
 
@@ -47,24 +82,15 @@ class OpenCavityData:
         without_optic = self.bounded_samples["ambient"]
 
         # Interpolate loss_optic to match the samples
-        tmp = pd.DataFrame(with_optic)
-        tmp.rename({0: 1}, axis=1, inplace=True)
-        tmp["id"] = "B"
-        tmp[1] = NaN
-        inter_loss_optic = pd.DataFrame(self.loss_optic)
-        inter_loss_optic["id"] = "A"
-        inter_loss_optic = pd.concat([tmp, inter_loss_optic])
-        inter_loss_optic.sort_index(inplace=True)
-        inter_loss_optic.interpolate(inplace=True)
-        inter_loss_optic.drop(
-            inter_loss_optic[inter_loss_optic["id"] == "A"].index, inplace=True, axis=0
+        inter_loss_optic = pd.Series(
+            loss_optic(with_optic.index), index=with_optic.index
         )
-        inter_loss_optic.drop(columns="id", inplace=True, axis=1)
 
         reflectivity = 1 - (
-            (with_optic / (without_optic - with_optic)) * inter_loss_optic.squeeze()
+            (with_optic / (without_optic - with_optic)) * inter_loss_optic
         )
         reflectivity.interpolate(inplace=True)
+        self.reflectivity = reflectivity
         return reflectivity
 
     def get_absorption(self, index, reflectivity):
@@ -74,17 +100,66 @@ class OpenCavityData:
             Ref=self.bounded_samples["ambient"],  # TODO: this should be the ambient
             Spec=self.bounded_samples["target"].loc[[index]].squeeze(),
             wl=self.bounded_samples["target"].loc[[index]].squeeze().index,
-            density_gas=self._get_density(),
+            density_gas=np.squeeze(self._get_density([index])),
         )
         return absorb
 
-    def _get_density(self):
+    # Same as get_absorption, but for every target timestamp in `rows` at once.
+    # target optionally replaces the bounded target window with other dark-corrected
+    # spectra.
+    def get_absorption_all(self, reflectivity, rows=slice(None), target=None):
+        if target is None:
+            target = self.bounded_samples["target"]
+        target = target.iloc[rows]
+        extinction = _extinction(
+            d0=CAVITY_LENGTH,
+            Reflectivity=np.asarray(reflectivity),
+            wl=target.columns,
+            density_gas=self._get_density(target.index),
+        )
+        Ref = np.asarray(self.bounded_samples["ambient"])
+        Spec = target.to_numpy()
+        alpha = np.asarray(extinction) * ((Ref - Spec) / Spec)
+
+        return pd.DataFrame(alpha, index=target.index, columns=target.columns)
+
+    # The density at each of times from the housekeeping log, as a column that
+    # scales every spectrum, or the fixed density.
+    def _get_density(self, times):
+        if self.housekeeping is not None:
+            density = housekeeping.densities(self.housekeeping, times, self.tolerance)
+            return density[:, None]
         target_dens = rayleigh.Density_calc(pressure=620, temp_K=298)
         return target_dens
 
 
+# The loss of the optic at wavelengths (nm), interpolated linearly from the table
+# in LOSS_OPTIC_FILE and held at its end values outside of it. The result is
+# cached for the last few wavelength grids.
+def loss_optic(wavelengths):
+    return _loss_optic(np.asarray(wavelengths, dtype=float).tobytes())
+
+
+@lru_cache(maxsize=32)
+def _loss_optic(wavelengths):
+    grid, loss = _loss_optic_table()
+    values = np.interp(np.frombuffer(wavelengths), grid, loss)
+    values.flags.writeable = False
+    return values
+
+
+@lru_cache(maxsize=None)
+def _loss_optic_table():
+    table = pd.read_csv(LOSS_OPTIC_FILE, header=None, index_col=0).sort_index()
+    return table.index.to_numpy(dtype=float), table[1].to_numpy(dtype=float)
+
+
 def _calculate_alpha(d0, Reflectivity, Ref, Spec, wl, density_gas):
-    Scat_Air = rayleigh.Rayleigh_Air(wl)
-    alpha = ((1 - Reflectivity) / d0 + density_gas * Scat_Air) * ((Ref - Spec) / Spec)
+    alpha = _extinction(d0, Reflectivity, wl, density_gas) * ((Ref - Spec) / Spec)
 
     return alpha
+
+
+def _extinction(d0, Reflectivity, wl, density_gas):
+    Scat_Air = rayleigh.Rayleigh_Air(wl)
+    return (1 - Reflectivity) / d0 + density_gas * Scat_Air
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+
+# Finds the dark, calibration and target periods of samples (timestamps x
+# wavelengths) for unattended runs, without a bounds file or the bounds picker.
+#
+# Every spectrum is reduced to its mean intensity in n_bands wavelength bands and
+# the spectra are averaged into at most n_blocks blocks in time. A change point is
+# where the log intensity or the shape of the band profile jumps by more than
+# `threshold` times its typical block-to-block noise, or where the data has a gap.
+# The blocks at either edge of a segment (which may straddle a valve switch) and
+# segments shorter than min_duration are left out.
+#
+# Segments darker than dark_fraction of the brightest one are dark. Segments longer
+# than max_calibration are target periods. The shorter ones between two target
+# periods form a calibration sequence if they are brighter than those target
+# periods, and are part of the target otherwise. In a calibration sequence the
+# brightest segments are levels[2] and the next brightest levels[1] (He and N2 for
+# a closed cavity, see the instruments' phase_levels); segments within rel_tol of
+# those levels count as the same gas. Anything else is left unlabelled.
+#
+# Returns one row per segment: its start and end (first and last spectrum), number
+# of spectra, median intensity and label (None when unlabelled).
+def detect_phases(
+    samples,
+    levels=("dark", "N2", "He"),
+    n_blocks=20000,
+    n_bands=8,
+    threshold=8.0,
+    min_duration="20s",
+    max_calibration="10min",
+    dark_fraction=0.1,
+    rel_tol=0.02,
+):
+    if not samples.index.is_monotonic_increasing:
+        samples = samples.sort_index()
+    n = len(samples)
+    if n < 2:
+        raise ValueError("Need at least two spectra to find phases")
+
+    # Band means of every spectrum, then block means in time. Blocks never span a
+    # gap in the data.
+    values = samples.to_numpy()
+    bands = np.unique(
+        np.linspace(0, values.shape[1], n_bands, endpoint=False).astype(int)
+    )
+    profile = np.add.reduceat(values, bands, axis=1, dtype=float)
+    profile /= np.diff(np.append(bands, values.shape[1]))
+
+    times = samples.index
+    seconds = np.asarray((times - times[0]).total_seconds())
+    steps = np.diff(seconds)
+    gaps = np.flatnonzero(steps > 10 * np.median(steps)) + 1
+    size = -(-n // n_blocks)
+    starts = np.union1d(np.arange(0, n, size), gaps)
+    counts = np.diff(np.append(starts, n))
+    blocks = np.add.reduceat(profile, starts, axis=0) / counts[:, None]
+
+    # Log intensity and the band profile normalised by it, as features.
+    level = blocks.mean(axis=1)
+    features = np.column_stack(
+        [np.log(np.maximum(level, 1e-9)), blocks / np.maximum(level, 1e-9)[:, None]]
+    )
+    jumps = np.abs(np.diff(features, axis=0))
+    # The noise is the larger of the typical jump over the whole dataset and over
+    # the blocks around each jump, since dim (e.g. dark) periods are noisier.
+    noise = np.maximum(
+        1.4826 * np.median(jumps, axis=0),
+        1e-4 * np.median(np.abs(features), axis=0) + 1e-12,
+    )
+    local = pd.DataFrame(jumps).rolling(31, center=True, min_periods=1).median()
+    noise = np.maximum(noise, 1.4826 * local.to_numpy())
+    change = (jumps / noise).max(axis=1) > threshold
+    change[np.isin(starts[1:], gaps)] = True
+
+    # Segments of blocks between change points, trimmed by a block at each edge.
+    edges = np.concatenate([[0], np.flatnonzero(change) + 1, [len(starts)]])
+    trim = 1 if size > 1 else 0
+    rows = []
+    for first, last in zip(edges[:-1], edges[1:] - 1):
+        first, last = first + trim, last - trim
+        if first > last:
+            continue
+        start, stop = starts[first], starts[last] + counts[last] - 1
+        if times[stop] - times[start] < pd.Timedelta(min_duration):
+            continue
+        rows.append(
+            {
+                "start": times[start],
+                "end": times[stop],
+                "spectra": stop - start + 1,
+                "intensity": float(np.median(level[first : last + 1])),
+            }
+        )
+    if not rows:
+        raise ValueError("No phases found")
+
+    segments = pd.DataFrame(rows)
+    segments["label"] = _label(
+        segments, levels, max_calibration, dark_fraction, rel_tol
+    )
+    return segments
+
+
+def _label(segments, levels, max_calibration, dark_fraction, rel_tol):
+    dark, low, high = levels
+    intensity = segments["intensity"].to_numpy()
+    labels = np.full(len(segments), None, dtype=object)
+
+    is_dark = intensity < dark_fraction * intensity.max()
+    labels[is_dark] = dark
+    is_target = (
+        ~is_dark
+        & (
+            segments["end"] - segments["start"] > pd.Timedelta(max_calibration)
+        ).to_numpy()
+    )
+    labels[is_target] = "target"
+
+    # Calibration sequences: runs of short segments between target periods whose
+    # brightest segment outshines the target periods around it. Other runs (e.g. a
+    # plume splitting a target period) are part of the target.
+    sequence = np.cumsum(is_target)
+    targets = np.flatnonzero(is_target)
+    for number in np.unique(sequence[~is_dark & ~is_target]):
+        members = np.flatnonzero((sequence == number) & ~is_dark & ~is_target)
+        around = targets[max(number - 1, 0) : number + 1]
+        if len(around) and intensity[members].max() < intensity[around].max() * (
+            1 + rel_tol
+        ):
+            labels[members] = "target"
+            continue
+        for label in (high, low):
+            brightest = intensity[members].max()
+            same = members[intensity[members] >= brightest * (1 - rel_tol)]
+            labels[same] = label
+            members = np.setdiff1d(members, same)
+            if not len(members):
+                break
+    return labels
+
+
+# Bounds (as read from a bounds file) for the labelled segments. Each window is
+# widened by half the sampling period, since bound_samples excludes its end
+# points. A key with one window gets a [start, end] pair, one with several a list
+# of pairs. Raises a ValueError when one of keys was not found.
+def to_bounds(segments, keys, period):
+    half = pd.Timedelta(period) / 2
+    bounds = {}
+    for key in keys:
+        found = segments[segments["label"] == key]
+        if found.empty:
+            raise ValueError(f"No {key} period found")
+        windows = [
+            [(start - half).isoformat(), (end + half).isoformat()]
+            for start, end in zip(found["start"], found["end"])
+        ]
+        bounds[key] = windows[0] if len(windows) == 1 else windows
+    return bounds
+
+
+# The typical time between spectra.
+def sampling_period(samples):
+    return pd.Series(samples.index).diff().median()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import fitting
+
+DEFAULT_CACHE = Path.home() / ".cache" / "bbceas_processing" / "cross_sections"
+DEFAULT_LOW = 306
+DEFAULT_HIGH = 312
+
+
+# Wavelengths of the instrument grid inside the fit window (end points excluded).
+def fit_wavelengths(wavelengths, low=DEFAULT_LOW, high=DEFAULT_HIGH):
+    wavelengths = pd.Index(wavelengths)
+    return wavelengths[(wavelengths > low) & (wavelengths < high)]
+
+
+# Interpolates each cross-section (Series or single-column DataFrame indexed by
+# wavelength) onto wavelengths and stacks them into one DataFrame, one column per
+# cross-section, backed by a single contiguous array.
+def align_cross_sections(cross_sections, wavelengths):
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    matrix = np.empty((len(wavelengths), len(cross_sections)), order="F")
+    for i, section in enumerate(cross_sections):
+        section = section.squeeze(axis=1) if section.ndim == 2 else section
+        section = section.sort_index()
+        grid = section.index.to_numpy(dtype=float)
+        if wavelengths.min() < grid[0] or wavelengths.max() > grid[-1]:
+            raise ValueError(
+                f"Cross-section {i} covers {grid[0]}-{grid[-1]} nm, which does not "
+                f"include {wavelengths.min()}-{wavelengths.max()} nm"
+            )
+        matrix[:, i] = np.interp(wavelengths, grid, section.to_numpy(dtype=float))
+
+    return pd.DataFrame(matrix, index=pd.Index(wavelengths))
+
+
+def read_cross_sections(files):
+    return [pd.read_csv(file, header=None, index_col=0) for file in files]
+
+
+# align_cross_sections() for cross-section CSV files, cached in cache_folder by the
+# content of the files and the wavelength grid so a repeated analysis does not read
+# or interpolate the CSVs again.
+def cross_section_matrix(files, wavelengths, cache_folder=DEFAULT_CACHE):
+    wavelengths = np.asarray(wavelengths, dtype=float)
+
+    key = hashlib.sha256(wavelengths.tobytes())
+    for file in files:
+        key.update(hashlib.sha256(Path(file).read_bytes()).digest())
+    path = Path(cache_folder) / f"{key.hexdigest()}.npy"
+
+    if path.exists():
+        return pd.DataFrame(np.load(path), index=pd.Index(wavelengths))
+
+    matrix = align_cross_sections(read_cross_sections(files), wavelengths)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, matrix.to_numpy())
+    return matrix
+
+
+# The list of single-column DataFrames that fitting and fit_curve_lm take.
+def split_cross_sections(matrix):
+    return [matrix[[column]] for column in matrix.columns]
+
+
+# The single window analyze() fits when it is not given any.
+def default_window(cross_sections):
+    return {
+        "name": "default",
+        "low": DEFAULT_LOW,
+        "high": DEFAULT_HIGH,
+        "cross_sections": cross_sections,
+    }
+
+
+# Prepares named fit windows on the instrument grid. Each window is a dict with a
+# name, low and high (nm, end points excluded), its cross_sections (a list, or a
+# matrix from cross_section_matrix on the window's wavelengths) and optionally the
+# order of its polynomial (2 by default). Returns the union of the windows'
+# wavelengths and, for each window, its name, wavelengths, their positions in the
+# union (columns), the split cross-sections and the design matrix.
+def fit_windows(grid, windows):
+    names = [window["name"] for window in windows]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Window names are not unique: {names}")
+
+    prepared = []
+    for window in windows:
+        name = window["name"]
+        wavelengths = fit_wavelengths(
+            grid, window.get("low", DEFAULT_LOW), window.get("high", DEFAULT_HIGH)
+        )
+        if len(wavelengths) == 0:
+            raise ValueError(f"Window {name} has no wavelengths")
+
+        cross_sections = window["cross_sections"]
+        if not isinstance(cross_sections, pd.DataFrame):
+            cross_sections = align_cross_sections(cross_sections, wavelengths)
+        elif not cross_sections.index.equals(wavelengths):
+            raise ValueError(
+                f"Cross-section wavelengths of window {name} do not match the samples"
+            )
+        cross_sections = split_cross_sections(cross_sections)
+        order = window.get("order", 2)
+        prepared.append(
+            {
+                "name": name,
+                "wavelengths": wavelengths,
+                "cross_sections": cross_sections,
+                "order": order,
+                "design": fitting.design_matrix(cross_sections, wavelengths, order),
+            }
+        )
+
+    union = pd.Index(grid)
+    union = union[union.isin(np.concatenate([w["wavelengths"] for w in prepared]))]
+    for window in prepared:
+        window["columns"] = union.get_indexer(window["wavelengths"])
+    return union, prepared
+
+
+# Reads fit windows from a JSON list of {"name", "low", "high", "cross_sections",
+# "order"} objects, where cross_sections lists CSV files (relative to the JSON
+# file). The cross-sections are interpolated onto grid (through the cache) so the
+# windows can go straight to analyze().
+def read_windows(path, grid, cache_folder=DEFAULT_CACHE):
+    path = Path(path)
+    windows = json.loads(path.read_text())
+    for window in windows:
+        wavelengths = fit_wavelengths(
+            grid, window.get("low", DEFAULT_LOW), window.get("high", DEFAULT_HIGH)
+        )
+        files = [path.parent / file for file in window["cross_sections"]]
+        window["cross_sections"] = cross_section_matrix(
+            files, wavelengths, cache_folder
+        )
+    return windows
@@ -1,122 +1,334 @@
-import pandas as pd
-
-from . import rayleigh
-
-
-def analyze(samples, bounds, cross_sections, instrument):
-    # Check that the cross-sections are the right size.
-    samples, cross_sections = check_size(samples, cross_sections)
-
-    # Replace sample's wavelength with the cross_section's wavelength.
-    samples.columns = cross_sections[0].index
-
-    # Select wavelengths we care about (306 - 312).
-    samples, cross_sections = select_wavelengths(samples, cross_sections, 306, 312)
-
-    bounded_samples = instrument.bound_samples(samples, bounds)
-
-    # instrument.get_densities()
-
-    reflectivity = instrument.get_reflectivity(samples)
-
-    print(reflectivity.to_string())
+from concurrent.futures import ThreadPoolExecutor
 
-    absorption_all = pd.DataFrame()
-    fit_data_all = pd.DataFrame()
-    fit_curve_values_all = pd.DataFrame()
-    time_stamps = []
-    for index in bounded_samples["target"].index:
-        time_stamps.append(index)
-        # make reflect and abs df and append results to each
-        absorption = instrument.get_absorption(index, reflectivity)
-        # concat indiv sample absorption to the df of all of the samples absorptions
-        absorption_all = pd.concat([absorption_all, absorption], axis=1)
-
-        x_data = absorption.index.to_numpy()
-        y_data = absorption.to_numpy()
-        fit_data, fit_curve_values = fit_curve_lm(cross_sections, x_data, y_data)
-
-        fit_data_all = pd.concat([fit_data_all, fit_data], axis=1)
-        fit_curve_values_all = pd.concat(
-            [fit_curve_values_all, pd.Series(fit_curve_values)], axis=1
-        )
-
-    absorption_all = absorption_all.T
-    absorption_all.index = time_stamps
-
-    fit_data_all = fit_data_all.T
-    fit_data_all.index = time_stamps
-
-    fit_curve_values_all = fit_curve_values_all.T
-    fit_curve_values_all.index = time_stamps
-
-    residuals_all = fit_data_all - absorption_all
-
-    # returns the timestamp of associated with the highest concentration
-    index_max_conc = fit_curve_values_all.idxmax()[0]
-    fit_data_highest = fit_data_all.loc[[index_max_conc]].squeeze()
-    absorption_highest = absorption_all.loc[[index_max_conc]].squeeze()
-    residuals_highest = residuals_all.loc[[index_max_conc]].squeeze()
+import numpy as np
+import pandas as pd
 
-    return {
+from . import fitting
+from . import prepare
+from . import profiling
+from . import utils
+
+
+# cross_sections is a list of cross-sections (Series or single-column DataFrames
+# indexed by wavelength) or a matrix from prepare.cross_section_matrix, fitted over
+# the default window (306 - 312 nm).
+# windows instead fits several named spectral windows, each with its own
+# cross-sections and polynomial order (see prepare.fit_windows); cross_sections is
+# then ignored. The calibration is computed once over the union of the windows, and
+# the windows are fitted concurrently on one thread each. Every window's results are
+# returned under "windows" by name, the first window's also at the top level. With
+# more than one window the writer gets each window's products prefixed with
+# "<name>_".
+# fit_method is either "linear" (one batch solve for every timestamp), "lm", which
+# keeps the original per-timestamp lmfit.minimize() loop as a reference, or "shift",
+# which also fits a wavelength shift and stretch of the cross-sections for every
+# timestamp (see fitting.fit_curves_shift); the shift and stretch then follow the
+# polynomial in the fit values.
+# Targets are processed `window` timestamps at a time. When a writer is given each
+# finished window is handed to writer.write() instead of being kept, so only one
+# window of absorption/fit data is held in memory.
+# calibration is a result of instrument.get_calibration() (returned as "calibration")
+# from an earlier run; it replaces bounding the calibration windows and computing the
+# reflectivity, so bounds then only needs a target window.
+# average (a pandas time span such as "10s") co-adds the dark-corrected target
+# spectra into bins of that length before absorption and fitting, so every result
+# is per bin; the number of spectra in each bin and their standard deviation are
+# returned as "coadd_counts" and "coadd_std".
+# profiler (a profiling.Profiler) records the time and memory of each stage and the
+# number of fits and optimizer evaluations; analyze is not instrumented without one.
+# housekeeping (see housekeeping.read_housekeeping) gives the gas densities from the
+# cell pressure and temperature at every timestamp instead of fixed ones; it is
+# handed to instrument.set_housekeeping().
+def analyze(
+    samples,
+    bounds,
+    cross_sections,
+    instrument,
+    fit_method="linear",
+    writer=None,
+    window=1000,
+    calibration=None,
+    average=None,
+    profiler=None,
+    windows=None,
+    housekeeping=None,
+):
+    if fit_method not in ("linear", "lm", "shift"):
+        raise ValueError(f"Unknown fit method: {fit_method}")
+    profiler = profiling.NULL if profiler is None else profiler
+    if housekeeping is not None:
+        instrument.set_housekeeping(housekeeping)
+
+    with profiler.stage("prepare"):
+        # Select the wavelengths of the fit windows and interpolate the
+        # cross-sections onto them, unless they were already prepared by
+        # prepare.cross_section_matrix.
+        if windows is None:
+            windows = [prepare.default_window(cross_sections)]
+        wavelengths, windows = prepare.fit_windows(samples.columns, windows)
+        prefix = len(windows) > 1
+        samples = samples[wavelengths]
+
+    with profiler.stage("calibration"):
+        if calibration is None:
+            bounded_samples = instrument.bound_samples(samples, bounds)
+            reflectivity = instrument.get_reflectivity(samples)
+        else:
+            # A time-resolved reflectivity has one row per calibration.
+            reflectivity = calibration["reflectivity"]
+            if reflectivity.ndim == 2:
+                grid = reflectivity.columns
+            else:
+                grid = reflectivity.index
+            if not grid.equals(samples.columns):
+                raise ValueError("Calibration wavelengths do not match the samples")
+            reflectivity = instrument.set_calibration(calibration)
+            bounded_samples = instrument.bound_target(samples, bounds)
+
+    coadd_counts = coadd_std = None
+    if average is not None:
+        with profiler.stage("coadd"):
+            target = bounded_samples["target"].sort_index()
+            target, coadd_counts, coadd_std = utils.coadd(target, average)
+            bounded_samples["target"] = target
+
+    time_stamps = bounded_samples["target"].index
+    n_times = len(time_stamps)
+    if n_times == 0:
+        raise ValueError("No target spectra in bounds")
+
+    # Preallocate the results. With a writer the per-wavelength buffers only hold
+    # one window and are reused; the per-timestamp fit values are always kept.
+    n_rows = n_times if writer is None else min(window, n_times)
+    absorption_values = np.empty((n_rows, len(wavelengths)))
+    fits = [_WindowFit(spec, n_times, n_rows, fit_method, profiler) for spec in windows]
+
+    pool = ThreadPoolExecutor(len(fits)) if len(fits) > 1 else None
+    try:
+        for start in range(0, n_times, window):
+            stop = min(start + window, n_times)
+            offset = start if writer is None else 0
+            rows = slice(offset, offset + stop - start)
+
+            with profiler.stage("absorption"):
+                if hasattr(instrument, "get_absorption_all"):
+                    absorption = instrument.get_absorption_all(
+                        reflectivity, slice(start, stop)
+                    )
+                    absorption_values[rows] = absorption.to_numpy()
+                else:
+                    for i, index in enumerate(time_stamps[start:stop]):
+                        absorption = instrument.get_absorption(index, reflectivity)
+                        absorption_values[offset + i] = absorption.to_numpy()
+
+            with profiler.stage("fit"):
+                args = (absorption_values[rows], time_stamps, start, stop, rows)
+                if pool is None:
+                    fits[0].fit(*args)
+                else:
+                    list(pool.map(lambda fit: fit.fit(*args), fits))
+
+            if writer is not None:
+                with profiler.stage("write"):
+                    # The absorption covers the union of the windows.
+                    writer.write(
+                        {
+                            "absorption": pd.DataFrame(
+                                absorption_values[rows],
+                                index=time_stamps[start:stop],
+                                columns=wavelengths,
+                            )
+                        }
+                    )
+                    for fit in fits:
+                        fit.write(writer, prefix, time_stamps, start, stop, rows)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    with profiler.stage("assemble"):
+        results = {
+            fit.name: fit.results(
+                time_stamps, None if writer is not None else absorption_values
+            )
+            for fit in fits
+        }
+
+    processed_data = {
         "samples": samples,
         "reflectivity": reflectivity,
-        "absorption_all": absorption_all,
-        "absorption_highest": absorption_highest,
-        "cross_sections_target": cross_sections[0],
-        "fit_data_all": fit_data_all,
-        "fit_data_highest": fit_data_highest,
-        "fit_curve_values": fit_curve_values_all,
-        "residuals_all": residuals_all,
-        "residuals_highest": residuals_highest,
+        "calibration": instrument.get_calibration(),
+        **results[fits[0].name],
+        "windows": results,
+        "coadd_counts": coadd_counts,
+        "coadd_std": coadd_std,
     }
+    return processed_data
+
+
+# The fit of one spectral window over every target timestamp: its buffers, the
+# spectra with the highest concentration seen so far and its results.
+class _WindowFit:
+    def __init__(self, spec, n_times, n_rows, fit_method, profiler):
+        self.name = spec["name"]
+        self.wavelengths = spec["wavelengths"]
+        self.columns = spec["columns"]
+        self.cross_sections = spec["cross_sections"]
+        self.design = spec["design"]
+        self.fit_method = fit_method
+        self.profiler = profiler
+
+        n_params = self.design.shape[1] + (2 if fit_method == "shift" else 0)
+        self.fit_data_values = np.empty((n_rows, len(self.wavelengths)))
+        self.fit_curve_values = np.empty((n_times, n_params))
+        self.fit_curve_errors = np.empty((n_times, n_params))
+        self.highest = None
+
+    # Fits the timestamps start:stop, whose absorption (over the union of the
+    # windows) is given, into the buffer rows `rows`.
+    def fit(self, absorption, time_stamps, start, stop, rows):
+        absorption = absorption[:, self.columns]
+        # A shift fit starts from the last timestamp of the previous window.
+        initial = self.fit_curve_values[start - 1] if start > 0 else None
+        (
+            self.fit_data_values[rows],
+            self.fit_curve_values[start:stop],
+            self.fit_curve_errors[start:stop],
+        ) = _fit_window(
+            self.cross_sections,
+            self.wavelengths,
+            absorption,
+            self.fit_method,
+            self.design,
+            self.profiler,
+            initial,
+        )
 
-
-def check_size(samples, cross_sections):
-    done_flag = False
-    while done_flag != True:
-        done_flag = True
-        for section in cross_sections:
-            diff = len(samples.columns) - len(section.index)
-            if diff > 0:
-                samples.drop(
-                    samples.columns[len(samples.columns) - diff], axis=1, inplace=True
-                )
-                done_flag = False
-                print("Dropped ", diff, " columns from samples to match cross_sections")
-            elif diff < 0:
-                section.drop(
-                    section.index[len(section.index) + diff], axis=0, inplace=True
+        # Keep the spectra associated with the highest concentration seen so far.
+        concentrations = self.fit_curve_values[start:stop, 0]
+        if not np.isnan(concentrations).all():
+            best = np.nanargmax(concentrations)
+            if self.highest is None or concentrations[best] > self.highest[1]:
+                self.highest = (
+                    time_stamps[start + best],
+                    concentrations[best],
+                    absorption[best].copy(),
+                    self.fit_data_values[rows][best].copy(),
                 )
-                done_flag = False
-                print("Dropped ", -diff, " rows from cross_section to match samples")
-    return samples, cross_sections
-
-
-def select_wavelengths(samples, cross_sections, low_bound, high_bound):
-    wavelengths = cross_sections[0].index
-    wavelengths = wavelengths[(wavelengths > low_bound) & (wavelengths < high_bound)]
-    for i in range(len(cross_sections)):
-        cross_sections[i].index = cross_sections[0].index
-
-    for section in range(len(cross_sections)):
-        # line below was added because of mismatch in index of multiple cross-sections
-        cross_sections[section] = cross_sections[section].loc[wavelengths]
-
-    return samples[wavelengths], cross_sections
 
+    def write(self, writer, prefix, time_stamps, start, stop, rows):
+        index = time_stamps[start:stop]
+        name = f"{self.name}_" if prefix else ""
+        writer.write(
+            {
+                f"{name}fit_data": pd.DataFrame(
+                    self.fit_data_values[rows], index=index, columns=self.wavelengths
+                ),
+                f"{name}fit_curve_values": pd.DataFrame(
+                    self.fit_curve_values[start:stop], index=index
+                ),
+                f"{name}fit_curve_errors": pd.DataFrame(
+                    self.fit_curve_errors[start:stop], index=index
+                ),
+            }
+        )
 
-def get_densities():
-    # find density of the gasses
-    N2_dens = rayleigh.Density_calc(pressure=620, temp_K=298)
-    He_dens = rayleigh.Density_calc(pressure=620, temp_K=298)
-    target_dens = rayleigh.Density_calc(pressure=620, temp_K=298)
+    def results(self, time_stamps, absorption_values):
+        fit_curve_values_all = pd.DataFrame(self.fit_curve_values, index=time_stamps)
+        fit_curve_errors_all = pd.DataFrame(self.fit_curve_errors, index=time_stamps)
+
+        if absorption_values is not None:
+            absorption_all = pd.DataFrame(
+                absorption_values[:, self.columns],
+                index=time_stamps,
+                columns=self.wavelengths,
+            )
+            fit_data_all = pd.DataFrame(
+                self.fit_data_values, index=time_stamps, columns=self.wavelengths
+            )
+            residuals_all = fit_data_all - absorption_all
+        else:
+            # The full matrices were streamed to the writer.
+            absorption_all = fit_data_all = residuals_all = None
 
-    return {"N2": N2_dens, "He": He_dens, "target": target_dens}
+        # returns the spectra associated with the highest concentration, or NaN
+        # spectra when no concentration was fitted
+        if self.highest is None:
+            index_max_conc, absorption_highest, fit_data_highest = None, np.nan, np.nan
+        else:
+            index_max_conc, _, absorption_highest, fit_data_highest = self.highest
+        absorption_highest = pd.Series(
+            absorption_highest, index=self.wavelengths, name=index_max_conc
+        )
+        fit_data_highest = pd.Series(
+            fit_data_highest, index=self.wavelengths, name=index_max_conc
+        )
+        residuals_highest = fit_data_highest - absorption_highest
+
+        return {
+            "absorption_all": absorption_all,
+            "absorption_highest": absorption_highest,
+            "cross_sections_target": self.cross_sections[0],
+            "fit_data_all": fit_data_all,
+            "fit_data_highest": fit_data_highest,
+            "fit_curve_values": fit_curve_values_all,
+            "fit_curve_errors": fit_curve_errors_all,
+            "gases": len(self.cross_sections),
+            "residuals_all": residuals_all,
+            "residuals_highest": residuals_highest,
+        }
+
+
+def _fit_window(
+    cross_sections, wavelengths, absorption, fit_method, design, profiler, initial=None
+):
+    # Optimizer statistics are only gathered when profiling.
+    stats = None if profiler is profiling.NULL else {}
+    n_polynomial = design.shape[1] - len(cross_sections)
+
+    if fit_method == "linear":
+        results = fitting.fit_curves_linear(
+            cross_sections, wavelengths, absorption, design, stats
+        )
+        if stats is not None:
+            profiler.fits(fit_method, stats["solves"])
+        return results
+
+    if fit_method == "shift":
+        results = fitting.fit_curves_shift(
+            cross_sections,
+            wavelengths,
+            absorption,
+            n_polynomial - 1,
+            initial,
+            stats=stats,
+        )
+        if stats is not None:
+            profiler.fits(fit_method, stats["nfev"])
+        return results
+
+    if n_polynomial != 3:
+        raise ValueError("The lm fit only supports a polynomial of order 2")
+    x_data = wavelengths.to_numpy()
+    fit_data = np.empty_like(absorption)
+    fit_curve_values = np.empty((len(absorption), design.shape[1]))
+    fit_curve_errors = np.empty((len(absorption), design.shape[1]))
+    evaluations = np.empty(len(absorption), dtype=int)
+    for i, y_data in enumerate(absorption):
+        fit_data[i], fit_curve_values[i], fit_curve_errors[i] = fit_curve_lm(
+            cross_sections, x_data, y_data, return_errors=True, stats=stats
+        )
+        if stats is not None:
+            evaluations[i] = stats["nfev"]
+    if stats is not None:
+        profiler.fits(fit_method, evaluations)
+    return fit_data, fit_curve_values, fit_curve_errors
 
 
 # Curve fitting function that relies on lmfit.minimize()
-def fit_curve_lm(cross_sections, xdata, ydata):
+# If stats (a dict) is given, stats["nfev"] is set to the number of function
+# evaluations the fit took.
+def fit_curve_lm(cross_sections, xdata, ydata, return_errors=False, stats=None):
     import lmfit
 
     # Create Parameter objects. There should be as many concentration parameters as there are cross-sections.
@@ -154,9 +366,7 @@ def fit_curve_lm(cross_sections, xdata, ydata):
             section = cross_sections[i]
             result += section[section.columns[0]] * concentration[i]
         # add the polynomial
-        result += a * wavelength**2
-        +b * wavelength
-        +c
+        result += a * wavelength**2 + b * wavelength + c
         return result
 
     # Returns the final fitted values. Accepts concentrations in a list of floats instead of a list of Parameter objects.
@@ -175,9 +385,7 @@ def fit_curve_lm(cross_sections, xdata, ydata):
             section = cross_sections[i]
             result += section[section.columns[0]] * concentration[i]
 
-        result += a * wavelength**2
-        +b * wavelength
-        +c
+        result += a * wavelength**2 + b * wavelength + c
         return result
 
     # Finds the residualbetween the fitted y values and the actual y values.
@@ -198,9 +406,15 @@ def fit_curve_lm(cross_sections, xdata, ydata):
 
     # Minimize the residual using the parameters given.
     fit = lmfit.minimize(residual, params, args=(xdata, ydata), method="leastsq")
+    if stats is not None:
+        stats["nfev"] = fit.nfev
     # Grab the concentration and polynomial values from the parameter objects.
     results = []
     for key, value in fit.params.valuesdict().items():
         results.append(value)
     # Return the fitted data and the concentration and polynomial values.
+    if return_errors:
+        errors = [param.stderr for param in fit.params.values()]
+        errors = [np.nan if error is None else error for error in errors]
+        return final_func(xdata, *results), results, errors
     return final_func(xdata, *results), results
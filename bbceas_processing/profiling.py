@@ -0,0 +1,100 @@
+import contextlib
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+
+# Collects per-stage wall time, CPU time and peak memory for analyze(), plus the
+# number of fits and the optimizer evaluations each of them took (function
+# evaluations for "lm", least-squares solves for "linear"). A stage entered more
+# than once (e.g. once per window) is accumulated. callback, if given, is called
+# with the stage name and its record every time a stage ends. With memory=True
+# allocations are traced with tracemalloc (which slows pure-Python code down) from
+# creation until close(); the peak of a stage is measured from what was allocated
+# when it started.
+class Profiler:
+    def __init__(self, callback=None, memory=True):
+        self.callback = callback
+        self.memory = memory
+        self.stages = {}
+        self.fit_method = None
+        self.evaluations = []
+        self._start = time.perf_counter()
+        self._started_tracing = memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.memory:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_mb": None}
+            )
+            record["calls"] += 1
+            record["wall_s"] += time.perf_counter() - wall
+            record["cpu_s"] += time.process_time() - cpu
+            if self.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                peak_mb = (peak - current) / 1e6
+                record["peak_mb"] = max(record["peak_mb"] or 0.0, peak_mb)
+            if self.callback is not None:
+                self.callback(name, record)
+
+    # Records fits, one optimizer evaluation count per fit.
+    def fits(self, method, evaluations):
+        self.fit_method = method
+        self.evaluations.extend(np.asarray(evaluations, dtype=int).tolist())
+
+    def report(self):
+        evaluations = np.asarray(self.evaluations)
+        return {
+            "wall_s": time.perf_counter() - self._start,
+            "stages": self.stages,
+            "fits": {
+                "method": self.fit_method,
+                "count": len(evaluations),
+                "evaluations_total": int(evaluations.sum()),
+                "evaluations_mean": (
+                    float(evaluations.mean()) if len(evaluations) else None
+                ),
+                "evaluations_max": int(evaluations.max()) if len(evaluations) else None,
+            },
+        }
+
+    def write(self, path):
+        Path(path).write_text(json.dumps(self.report(), indent=2))
+
+
+# Stands in for a Profiler when analyze() is not being profiled, so the stages
+# cost one attribute lookup each.
+class NullProfiler:
+    _context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def fits(self, method, evaluations):
+        pass
+
+
+NULL = NullProfiler()
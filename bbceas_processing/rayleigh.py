@@ -1,6 +1,64 @@
+from collections import OrderedDict
+from functools import wraps
+
 import numpy as np
+import pandas as pd
+
+
+# The scattering cross-sections only depend on the wavelength grid, which is the
+# same for calibration, absorption and every repeated run over a dataset, so the
+# results for the last few grids are kept and reused.
+CACHE_SIZE = 32
+_cache = OrderedDict()
+
+
+def _cached(func):
+    @wraps(func)
+    def wrapper(wl):
+        if np.ndim(wl) == 0:
+            return func(wl)
+
+        wl = np.asarray(wl, dtype=float)
+        key = (func.__name__, wl.shape, wl.tobytes())
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+        XS = np.asarray(func(wl), dtype=float)
+        _store(key, XS)
+        return XS
+
+    return wrapper
+
+
+def _store(key, XS):
+    XS.flags.writeable = False
+    _cache[key] = XS
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def clear_cache():
+    _cache.clear()
+
+
+# Seeds the cache with a table from scattering_table() that was computed elsewhere
+# (e.g. by the parent of a process pool), so it is used instead of recomputed.
+def preload(table):
+    wl = table.index.to_numpy(dtype=float)
+    for name, func in [("N2", Rayleigh_N2), ("He", Rayleigh_He), ("Air", Rayleigh_Air)]:
+        _store((func.__name__, wl.shape, wl.tobytes()), table[name].to_numpy())
 
 
+# Scattering cross-sections of N2, He and air for a wavelength grid.
+def scattering_table(wl):
+    return pd.DataFrame(
+        {"N2": Rayleigh_N2(wl), "He": Rayleigh_He(wl), "Air": Rayleigh_Air(wl)},
+        index=pd.Index(wl),
+    )
+
+
+@_cached
 def Rayleigh_Air(wl):
 
     # Rayleigh Scattering of Air, Bates 1984
@@ -37,41 +95,30 @@ def Rayleigh_Air(wl):
     return Sigma
 
 
+@_cached
 def Rayleigh_N2(wl):
-    wn = (wl * 1e-7) ** -1
+    wn = (np.asarray(wl, dtype=float) * 1e-7) ** -1
     wl_E = wn**-1
 
-    if type(wl) == float or type(wl) == int:
-
-        if 21360 < wn:
-            RI_2 = 318.81874e12 / (14.4e9 - wn**2)
-            RI = (5677.465 + RI_2) / 1e8 + 1
-        else:
-            RI_2 = 307.43305e12 / (14.4e9 - wn**2)
-            RI = (6498.2 + RI_2) / 1e8 + 1
-
-        XSA = 8 * np.pi**3 / wl_E**4 / (2.546899e19) ** 2 / 3
-        XSB = (RI**2 - 1) ** 2
-        Fk = 1.034 + 3.17e-12 * wn**2
-        XS = XSA * XSB * Fk
-
-    else:
-        XS = np.empty_like(wl)
-        for i, x in enumerate(wn):
-            if 21360 < x:
-                RI_2 = 318.81874e12 / (14.4e9 - x**2)
-                RI = (5677.465 + RI_2) / 1e8 + 1
-            else:
-                RI_2 = 307.43305e12 / (14.4e9 - x**2)
-                RI = (6498.2 + RI_2) / 1e8 + 1
-
-            XSA = 8 * np.pi**3 / wl_E[i:] ** 4 / (2.546899e19) ** 2 / 3
-            XSB = (RI**2 - 1) ** 2
-            Fk = 1.034 + 3.17e-12 * x**2
-            XS[i:] = XSA * XSB * Fk
+    # The refractive index formula changes above 21360 cm^-1.
+    RI_2 = np.where(
+        21360 < wn,
+        318.81874e12 / (14.4e9 - wn**2),
+        307.43305e12 / (14.4e9 - wn**2),
+    )
+    RI = (np.where(21360 < wn, 5677.465, 6498.2) + RI_2) / 1e8 + 1
+
+    XSA = 8 * np.pi**3 / wl_E**4 / (2.546899e19) ** 2 / 3
+    XSB = (RI**2 - 1) ** 2
+    Fk = 1.034 + 3.17e-12 * wn**2
+    XS = XSA * XSB * Fk
+
+    if np.ndim(wl) == 0:
+        return float(XS)
     return XS
 
 
+@_cached
 def Rayleigh_He(wl):
     wn = (wl * 1e-7) ** -1
     RI_2 = 1.8102e13 / (1.5342e10 - wn**2)
@@ -89,9 +136,3 @@ def Density_calc(pressure, temp_K):
     Density_gas = Den1 * 6.0221415e23 / 1000
 
     return Density_gas
-
-
-
-
-
-
@@ -0,0 +1,125 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from . import fitting
+from . import prepare
+from . import utils
+
+
+# Fits spectra as they arrive (or chunk by chunk, see chunked.analyze_chunked). The
+# calibration (dark, reflectivity) is computed once from the dark and N2/He (or
+# ambient/with-optic) windows of `samples` given by `bounds`; a target window is not
+# needed.
+class StreamAnalyzer:
+    def __init__(self, samples, bounds, cross_sections, instrument):
+        # Positions of the fit window in a full raw spectrum.
+        grid = samples.columns
+        self.columns = grid.get_indexer(prepare.fit_wavelengths(grid))
+        self.n_pixels = len(grid)
+        self.wavelengths = grid[self.columns]
+        samples = samples.iloc[:, self.columns]
+
+        if not isinstance(cross_sections, pd.DataFrame):
+            cross_sections = prepare.align_cross_sections(
+                cross_sections, self.wavelengths
+            )
+        self.cross_sections = prepare.split_cross_sections(cross_sections)
+        self.design = fitting.design_matrix(self.cross_sections, self.wavelengths)
+
+        self.instrument = instrument
+        self.dark = instrument.bound_samples(samples, bounds)["dark"]
+        self.reflectivity = instrument.get_reflectivity(samples)
+
+    # Returns the absorption, fitted data, fit values (concentrations followed by the
+    # polynomial) and their standard errors for spectra (rows) taken at timestamps.
+    # spectra only cover the fit window (self.wavelengths).
+    def fit(self, timestamps, spectra):
+        target = utils.subtract_dark(
+            pd.DataFrame(
+                np.atleast_2d(spectra), index=timestamps, columns=self.wavelengths
+            ),
+            self.dark,
+        )
+
+        absorption = self.instrument.get_absorption_all(
+            self.reflectivity, target=target
+        )
+        fit_data, values, errors = fitting.fit_curves_linear(
+            self.cross_sections, self.wavelengths, absorption.to_numpy(), self.design
+        )
+
+        return {
+            "absorption": absorption,
+            "fit_data": pd.DataFrame(
+                fit_data, index=timestamps, columns=self.wavelengths
+            ),
+            "fit_curve_values": pd.DataFrame(values, index=timestamps),
+            "fit_curve_errors": pd.DataFrame(errors, index=timestamps),
+        }
+
+    # Returns the fit values (columns 0..n) followed by their standard errors
+    # (columns err_0..err_n) for full raw spectra.
+    def process(self, timestamps, spectra):
+        spectra = np.atleast_2d(spectra)[:, self.columns]
+        results = self.fit(timestamps, spectra)
+        errors = results["fit_curve_errors"].add_prefix("err_")
+        return pd.concat([results["fit_curve_values"], errors], axis=1)
+
+
+# Polls in_folder every `interval` seconds and fits each new .asc file with
+# analyzer. Results, with the lag in seconds between a file landing on disk and its
+# result, are appended to one CSV per day in writer's folder. Files that are already
+# there at start are skipped unless include_existing is set, and with once=True the
+# folder is processed a single time instead of watched. report is called after every
+# batch with the number of spectra processed so far, the rate and the latest lag.
+def watch(
+    in_folder,
+    analyzer,
+    writer,
+    interval=0.5,
+    include_existing=False,
+    once=False,
+    report=print,
+):
+    in_folder = Path(in_folder)
+    seen = set() if include_existing else set(in_folder.glob("*.asc"))
+    processed = 0
+    started = time.time()
+
+    while True:
+        files = sorted(set(in_folder.glob("*.asc")) - seen)
+
+        timestamps, spectra, landed = [], [], []
+        for file in files:
+            try:
+                landed_at = file.stat().st_mtime
+                timestamp, _, intensities = utils.read_asc(file)
+            except (OSError, ValueError):
+                # Most likely still being written; try again on the next poll.
+                continue
+            if len(intensities) < analyzer.n_pixels:
+                continue
+            seen.add(file)
+            timestamps.append(timestamp)
+            spectra.append(intensities)
+            landed.append(landed_at)
+
+        if timestamps:
+            results = analyzer.process(pd.DatetimeIndex(timestamps), np.array(spectra))
+            results["lag"] = time.time() - np.array(landed)
+            for day, day_results in results.groupby(results.index.date):
+                writer.write({f"concentrations_{day}": day_results})
+
+            processed += len(results)
+            report(
+                f"{processed} spectra, "
+                f"{processed / (time.time() - started):.1f} spectra/s, "
+                f"lag {results['lag'].iloc[-1]:.2f} s"
+            )
+
+        if once:
+            return processed
+        time.sleep(interval)
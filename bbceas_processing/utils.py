@@ -1,17 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
 from pathlib import Path
 
 import arrow
+import numpy as np
 import pandas as pd
 
+ASC_HEADER_LINES = 32
 
-def process_asc(folder):
+
+# Reads every .asc file in folder into one DataFrame (timestamps x wavelengths) of
+# intensities of the given dtype.
+def process_asc(folder, workers=None, progress=None, dtype=float):
     folder = Path(folder)
 
-    files = [file for file in folder.iterdir() if file.suffix == ".asc"]
-    data = [asc_to_df(file) for file in files]
+    files = sorted(file for file in folder.iterdir() if file.suffix == ".asc")
+    if not files:
+        raise ValueError(f"No .asc files found in {folder}")
+
+    return read_asc_files(files, workers=workers, progress=progress, dtype=dtype)
+
+
+# Reads the given .asc files into one DataFrame, one row per file in the same order.
+# The wavelength axis is read from the first file and every other file is checked
+# against it, so the intensities can go straight into one preallocated array.
+# Files are parsed by `workers` processes (all CPUs by default, 1 to parse in this
+# process). progress, if given, is called with the number of files finished at each
+# step.
+def read_asc_files(files, workers=None, progress=None, dtype=float):
+    _, wavelengths, _ = read_asc(files[0])
+
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, min(256, len(files) // (workers * 4)))
+    chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+
+    timestamps = []
+    data = np.empty((len(files), len(wavelengths)), dtype=dtype)
+    if workers == 1:
+        results = (_read_asc_chunk(chunk, wavelengths) for chunk in chunks)
+        _collect(results, timestamps, data, progress)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(_read_asc_chunk, chunks, [wavelengths] * len(chunks))
+            _collect(results, timestamps, data, progress)
+
+    return pd.DataFrame(data, index=timestamps, columns=wavelengths)
+
+
+def _collect(results, timestamps, data, progress):
+    for chunk_timestamps, chunk_data in results:
+        start = len(timestamps)
+        data[start : start + len(chunk_data)] = chunk_data
+        timestamps.extend(chunk_timestamps)
+        if progress is not None:
+            progress(len(chunk_data))
+
 
-    index, data = zip(*data)
-    return pd.DataFrame(data, index=index)
+def _read_asc_chunk(files, wavelengths):
+    timestamps = []
+    data = np.empty((len(files), len(wavelengths)))
+    for i, file in enumerate(files):
+        timestamp, file_wavelengths, data[i] = read_asc(file)
+        if not np.array_equal(file_wavelengths, wavelengths):
+            raise ValueError(f"{file} has a different wavelength axis")
+        timestamps.append(timestamp)
+    return timestamps, data
+
+
+# Fast-path parser: returns the timestamp, wavelengths and intensities as arrays.
+def read_asc(filename):
+    with open(filename) as f:
+        timestamp = _asc_timestamp(f.readline())
+        for _ in range(ASC_HEADER_LINES - 1):
+            f.readline()
+        values = np.array(f.read().split(), dtype=float).reshape(-1, 2)
+
+    return timestamp, values[:, 0], values[:, 1]
 
 
 def asc_to_df(filename):
@@ -19,12 +83,169 @@ def asc_to_df(filename):
         lines = f.readlines()
 
         # First line contains the timestamp
-        timestamp = lines[0].split(":", 1)[1].strip()
-        timestamp = arrow.get(timestamp, "ddd MMM D HH:mm:ss.S YYYY").datetime
+        timestamp = _asc_timestamp(lines[0])
 
         # Get the data from the rest of the file
-        index, data = zip(*[line.strip().split("\t", 1) for line in lines[32:]])
+        index, data = zip(
+            *[line.strip().split("\t", 1) for line in lines[ASC_HEADER_LINES:]]
+        )
         index = map(float, index)
         data = map(float, data)
 
         return timestamp, pd.Series(data=data, index=index)
+
+
+def _asc_timestamp(line):
+    timestamp = line.split(":", 1)[1].strip()
+    return arrow.get(timestamp, "ddd MMM D HH:mm:ss.S YYYY").datetime
+
+
+# Bounds map each key (dark, N2, target, ...) to a [start, end] window or to a list
+# of such windows. Returns the windows of every key as UTC Timestamps.
+def parse_bounds(bounds):
+    windows = {}
+    for key, value in bounds.items():
+        if len(value) and isinstance(value[0], (list, tuple)):
+            pairs = value
+        else:
+            pairs = [value]
+        windows[key] = [
+            tuple(pd.Timestamp(arrow.get(edge).to("utc").datetime) for edge in pair)
+            for pair in pairs
+        ]
+    return windows
+
+
+# Earliest start and latest end over the windows of `keys` (all keys by default).
+def bounds_span(bounds, keys=None):
+    windows = parse_bounds(bounds)
+    pairs = [pair for key in keys or windows for pair in windows[key]]
+    return min(start for start, _ in pairs), max(end for _, end in pairs)
+
+
+# Returns, for every key in bounds, the list of samples rows inside each of its
+# windows (end points excluded). Windows are found by binary search on the sorted
+# time index and returned as slices of samples rather than copies.
+def bound_windows(samples, bounds):
+    if not samples.index.is_monotonic_increasing:
+        samples = samples.sort_index()
+
+    windows = parse_bounds(bounds)
+    keys = [key for key, pairs in windows.items() for _ in pairs]
+    starts = pd.DatetimeIndex(
+        [start for pairs in windows.values() for start, _ in pairs]
+    )
+    ends = pd.DatetimeIndex([end for pairs in windows.values() for _, end in pairs])
+    if samples.index.tz is not None:
+        starts, ends = starts.tz_convert(samples.index.tz), ends.tz_convert(
+            samples.index.tz
+        )
+
+    bounded = {key: [] for key in windows}
+    starts = samples.index.searchsorted(starts, side="right")
+    ends = samples.index.searchsorted(ends, side="left")
+    for key, start, end in zip(keys, starts, ends):
+        bounded[key].append(samples.iloc[start:end])
+    return bounded
+
+
+# Mean spectrum over all rows of the windows, accumulated in double precision
+# whatever the dtype of the samples.
+def windows_mean(windows):
+    total = sum(window.to_numpy().sum(axis=0, dtype=float) for window in windows)
+    count = sum(len(window) for window in windows)
+    return pd.Series(total / count, index=windows[0].columns)
+
+
+# Mean spectrum of each window that has rows, indexed by the time halfway between
+# its first and last rows, for calibrations that change over time.
+def windows_means(windows):
+    windows = [window for window in windows if len(window)]
+    if not windows:
+        raise ValueError("No samples in any calibration window")
+    means = np.vstack(
+        [window.to_numpy().mean(axis=0, dtype=float) for window in windows]
+    )
+    times = pd.DatetimeIndex(
+        [
+            window.index[0] + (window.index[-1] - window.index[0]) / 2
+            for window in windows
+        ]
+    )
+    return pd.DataFrame(means, index=times, columns=windows[0].columns).sort_index()
+
+
+# Linearly interpolates the rows of values (a DataFrame indexed by time) at every
+# one of times, holding the first and last rows outside of them. Each row is a
+# weighted sum of the two rows around it, so this is one gather and one
+# multiply-add over the whole array.
+def interpolate_rows(values, times):
+    array = values.to_numpy(dtype=float)
+    if len(array) == 1:
+        return np.repeat(array, len(times), axis=0)
+
+    origin = values.index[0]
+    points = np.asarray((values.index - origin).total_seconds())
+    positions = np.asarray((pd.DatetimeIndex(times) - origin).total_seconds())
+    right = np.clip(
+        np.searchsorted(points, positions, side="right"), 1, len(points) - 1
+    )
+    left = right - 1
+    weights = (positions - points[left]) / (points[right] - points[left])
+    weights = np.clip(weights, 0, 1)[:, None]
+    return array[left] * (1 - weights) + array[right] * weights
+
+
+# Subtracts the dark spectrum from every row of target, keeping target's dtype so
+# float32 samples are not copied to float64. A time-resolved dark (a DataFrame of
+# dark spectra indexed by time, see windows_means) is interpolated onto target's
+# timestamps.
+def subtract_dark(target, dark):
+    values = target.to_numpy()
+    if isinstance(dark, pd.DataFrame):
+        dark = interpolate_rows(dark, target.index)
+    else:
+        dark = dark.to_numpy()
+    return pd.DataFrame(
+        values - dark.astype(values.dtype),
+        index=target.index,
+        columns=target.columns,
+    )
+
+
+# All rows of the windows as one DataFrame (no copy for a single window).
+def windows_concat(windows):
+    if len(windows) == 1:
+        return windows[0]
+    return pd.concat(windows)
+
+
+# Averages the rows of data (sorted by time) into bins of `period` (a pandas time
+# span such as "10s"), aligned to multiples of period. Returns the mean spectrum of
+# each bin (indexed by the bin's start), the number of spectra in each bin and the
+# standard deviation of each bin's spectra (NaN for bins of one spectrum). Empty
+# data gives empty results.
+def coadd(data, period):
+    if len(data) == 0:
+        empty = data.astype(float)
+        counts = pd.Series(np.zeros(0, dtype=int), index=data.index, name="count")
+        return empty, counts, empty.copy()
+
+    labels = data.index.floor(pd.Timedelta(period))
+    starts = np.flatnonzero(np.append(True, labels[1:] != labels[:-1]))
+    counts = np.diff(np.append(starts, len(data)))
+
+    values = data.to_numpy()
+    means = np.add.reduceat(values, starts, axis=0, dtype=float) / counts[:, None]
+    deviations = values - np.repeat(means, counts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(
+            np.add.reduceat(deviations**2, starts, axis=0) / (counts[:, None] - 1)
+        )
+
+    index = labels[starts]
+    return (
+        pd.DataFrame(means, index=index, columns=data.columns),
+        pd.Series(counts, index=index, name="count"),
+        pd.DataFrame(std, index=index, columns=data.columns),
+    )
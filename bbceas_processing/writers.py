@@ -0,0 +1,24 @@
+from pathlib import Path
+
+
+# Appends each window of results handed over by analyze() to one CSV per product
+# (absorption.csv, fit_data.csv, fit_curve_values.csv, fit_curve_errors.csv).
+# With append=True, files left by an earlier run are continued instead of replaced.
+class CsvWriter:
+    def __init__(self, out_folder, append=False):
+        self.out_folder = Path(out_folder)
+        self.out_folder.mkdir(parents=True, exist_ok=True)
+        self.append = append
+        self.paths = {}
+
+    def write(self, frames):
+        for name, frame in frames.items():
+            if name not in self.paths:
+                self.paths[name] = self.out_folder / f"{name}.csv"
+                if self.append and self.paths[name].exists():
+                    frame.to_csv(self.paths[name], mode="a", header=False)
+                else:
+                    # First window of this product: start a new file with a header.
+                    frame.to_csv(self.paths[name], mode="w")
+            else:
+                frame.to_csv(self.paths[name], mode="a", header=False)
@@ -0,0 +1,84 @@
+# Checks that storing and analyzing intensities as float32 retrieves the same
+# concentrations as float64 (within --tolerance, relative to the peak
+# concentration) and compares the size, load time and analyze time of both.
+#
+#   python benchmarks/bench_dtype.py [--targets 5000] [--pixels 1024]
+import argparse
+import contextlib
+import io
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bbceas_processing
+from bbceas_processing import dataset
+
+import synthetic
+
+
+def folder_size(path):
+    return sum(file.stat().st_size for file in Path(path).rglob("*") if file.is_file())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare float32 and float64")
+    parser.add_argument("--targets", type=int, default=5000)
+    parser.add_argument("--pixels", type=int, default=1024)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    samples, bounds, cross_sections, injected = synthetic.generate(
+        n_target=args.targets, n_pixels=args.pixels
+    )
+
+    results = {}
+    print(
+        f"{'dtype':<8} {'disk (MB)':>10} {'RAM (MB)':>10} {'load (s)':>10} {'analyze (s)':>12}"
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        for dtype in ["float64", "float32"]:
+            path = Path(folder) / dtype
+            dataset.write(samples, path, dtype=dtype)
+
+            start = time.perf_counter()
+            data = dataset.load(path)
+            loaded = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[dtype] = bbceas_processing.analyze(
+                    data,
+                    bounds,
+                    cross_sections,
+                    bbceas_processing.closed_cavity_data.ClosedCavityData(),
+                )
+            analyzed = time.perf_counter() - start
+
+            print(
+                f"{dtype:<8} {folder_size(path) / 1e6:>10.1f} "
+                f"{data.memory_usage(index=False).sum() / 1e6:>10.1f} "
+                f"{loaded:>10.3f} {analyzed:>12.3f}"
+            )
+
+    n_gases = len(cross_sections)
+    single = results["float32"]["fit_curve_values"].iloc[:, :n_gases]
+    double = results["float64"]["fit_curve_values"].iloc[:, :n_gases]
+    difference = float(((single - double).abs() / double.abs().max()).max().max())
+    error = synthetic.retrieval_error(results["float32"]["fit_curve_values"], injected)
+    print(f"largest float32 - float64 difference (relative to peak): {difference:.2e}")
+    print(
+        f"float32 error against injected concentrations: median {error['median']:.2%}"
+    )
+
+    if not np.isfinite(difference) or difference > args.tolerance:
+        print(f"FAIL: above tolerance {args.tolerance:.0e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Compares the fit methods on absorption spectra whose cross-sections are shifted
+# along the wavelength axis, as when the spectrometer's wavelength calibration
+# drifts: evaluations and time per fit and the error of the retrieved
+# concentrations (relative to each gas's peak) and shift.
+#
+#   python benchmarks/bench_fit.py [--spectra 500] [--pixels 150] [--shift 0.03]
+#
+# fit_curve_lm (lmfit, one spectrum at a time) is only run on the first
+# --per_spectrum spectra. "shift cold" starts every fit from a linear fit instead
+# of the previous spectrum's solution.
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bbceas_processing import fitting
+from bbceas_processing import prepare
+from bbceas_processing import process
+
+import synthetic
+
+
+# Absorption spectra (spectra x wavelengths) of gases whose cross-sections are
+# moved by shift (nm), a polynomial baseline and noise, with the injected
+# concentrations and the unshifted cross-sections on the grid.
+def shifted_spectra(n_spectra, n_pixels, shift, noise, seed=0):
+    wavelengths = np.linspace(306, 312, n_pixels)
+    # Built on a wide, fine grid so the shifted ones cover the fit window.
+    wide = synthetic.synthetic_cross_sections(np.linspace(300, 318, 4000), 2)
+    grid = pd.Index(wavelengths)
+    cross_sections = prepare.align_cross_sections(wide, grid)
+    shifted = prepare.align_cross_sections(
+        [pd.DataFrame({1: xs[1].to_numpy()}, index=xs.index - shift) for xs in wide],
+        grid,
+    ).to_numpy()
+
+    t = np.linspace(0, 6, n_spectra)
+    concentrations = pd.DataFrame(
+        {0: 2e12 * (0.55 + 0.45 * np.sin(t)), 1: 5e11 * (0.55 + 0.45 * np.cos(t))}
+    )
+    rng = np.random.default_rng(seed)
+    absorption = (
+        concentrations.to_numpy() @ shifted.T
+        + 2e-9
+        + 1e-11 * (wavelengths - 309)
+        + rng.normal(0, noise, (n_spectra, n_pixels))
+    )
+    return (
+        prepare.split_cross_sections(cross_sections),
+        wavelengths,
+        absorption,
+        concentrations,
+    )
+
+
+def fit_lm(cross_sections, wavelengths, absorption, stats):
+    values, evaluations = [], []
+    for y in absorption:
+        _, fit_values, _ = process.fit_curve_lm(
+            cross_sections, wavelengths, y, return_errors=True, stats=stats
+        )
+        values.append(fit_values)
+        evaluations.append(stats["nfev"])
+    stats["nfev"] = np.array(evaluations)
+    return None, np.array(values), None
+
+
+def fit_linear(cross_sections, wavelengths, absorption, stats):
+    return fitting.fit_curves_linear(
+        cross_sections, wavelengths, absorption, stats=stats
+    )
+
+
+def fit_shift(cross_sections, wavelengths, absorption, stats):
+    return fitting.fit_curves_shift(
+        cross_sections, wavelengths, absorption, stats=stats
+    )
+
+
+def fit_shift_cold(cross_sections, wavelengths, absorption, stats):
+    return fitting.fit_curves_shift(
+        cross_sections, wavelengths, absorption, warm_start=False, stats=stats
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fit methods")
+    parser.add_argument("--spectra", type=int, default=500)
+    parser.add_argument("--pixels", type=int, default=150)
+    parser.add_argument("--shift", type=float, default=0.03)
+    parser.add_argument("--noise", type=float, default=2e-11)
+    parser.add_argument("--per_spectrum", type=int, default=50)
+    args = parser.parse_args()
+
+    cross_sections, wavelengths, absorption, injected = shifted_spectra(
+        args.spectra, args.pixels, args.shift, args.noise
+    )
+    # Import the optimizers before timing.
+    import lmfit  # noqa: F401
+    import scipy.optimize  # noqa: F401
+
+    methods = [
+        ("lm", min(args.per_spectrum, args.spectra), fit_lm),
+        ("linear", args.spectra, fit_linear),
+        ("shift", args.spectra, fit_shift),
+        ("shift cold", args.spectra, fit_shift_cold),
+    ]
+
+    print(
+        f"{'method':<12} {'spectra':>8} {'evals/fit':>10} {'ms/fit':>8} "
+        f"{'median err':>11} {'max err':>9} {'shift':>8}"
+    )
+    for name, n, fit in methods:
+        stats = {}
+        start = time.perf_counter()
+        _, values, _ = fit(cross_sections, wavelengths, absorption[:n], stats)
+        elapsed = time.perf_counter() - start
+
+        error = synthetic.retrieval_error(pd.DataFrame(values), injected[:n])
+        evaluations = np.mean(stats.get("nfev", stats.get("solves")))
+        shift = np.median(values[:, -2]) if name.startswith("shift") else np.nan
+        print(
+            f"{name:<12} {n:>8} {evaluations:>10.1f} {1e3 * elapsed / n:>8.2f} "
+            f"{error['median']:>11.4f} {error['max']:>9.4f} {shift:>8.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# Times each stage of the closed-cavity pipeline on synthetic datasets (see
+# synthetic.py) at several scales and checks the retrieved concentrations against
+# the injected ones.
+#
+#   python benchmarks/bench_pipeline.py [--scales 500x1024 5000x1024 ...]
+#
+# A scale is <target spectra>x<pixels>. Each stage is run once for its time and
+# again under tracemalloc for its peak memory (allocations made in the parser
+# worker processes are not counted). get_absorption and fit_curve_lm work one
+# spectrum at a time and are only run on the first --per_spectrum spectra.
+import argparse
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bbceas_processing
+from bbceas_processing import dataset
+from bbceas_processing import prepare
+from bbceas_processing import process
+from bbceas_processing import utils
+
+import synthetic
+
+
+# Returns func's result, its run time (s) and peak traced memory (bytes).
+def measure(func, memory=True):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_scale(n_target, n_pixels, folder, args):
+    samples, bounds, cross_sections, injected = synthetic.generate(
+        n_target=n_target, n_pixels=n_pixels, noise=args.noise, seed=args.seed
+    )
+    n_spectra = len(samples)
+    stages = []
+
+    def record(name, func, count, memory=True):
+        result, elapsed, peak = measure(func, memory)
+        stages.append(
+            {
+                "stage": name,
+                "spectra": count,
+                "seconds": elapsed,
+                "spectra_per_s": count / elapsed if elapsed else float("inf"),
+                "peak_mb": None if peak is None else peak / 1e6,
+            }
+        )
+        return result
+
+    asc_folder = folder / "asc"
+    if not args.no_asc:
+        synthetic.write_asc(samples, asc_folder)
+        record(
+            "process_asc",
+            lambda: utils.process_asc(asc_folder, workers=args.workers),
+            n_spectra,
+        )
+
+    dataset.write(samples, folder / "dataset")
+    record("dataset.load", lambda: dataset.load(folder / "dataset"), n_spectra)
+
+    instrument = bbceas_processing.closed_cavity_data.ClosedCavityData()
+    wavelengths = prepare.fit_wavelengths(samples.columns)
+    window = samples[wavelengths]
+    record("bound_samples", lambda: instrument.bound_samples(window, bounds), n_spectra)
+    reflectivity = record(
+        "get_reflectivity", lambda: instrument.get_reflectivity(window), 1
+    )
+
+    target = instrument.bounded_samples["target"]
+    rows = target.index[: args.per_spectrum]
+    record(
+        "get_absorption",
+        lambda: [instrument.get_absorption(row, reflectivity) for row in rows],
+        len(rows),
+    )
+    absorption = record(
+        "get_absorption_all",
+        lambda: instrument.get_absorption_all(reflectivity),
+        n_target,
+    )
+
+    sections = prepare.split_cross_sections(
+        prepare.align_cross_sections(cross_sections, wavelengths)
+    )
+    record(
+        "fit_curve_lm",
+        lambda: [
+            process.fit_curve_lm(sections, wavelengths, absorption.loc[row])
+            for row in rows
+        ],
+        len(rows),
+        memory=False,
+    )
+
+    def analyze():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return bbceas_processing.analyze(
+                samples, bounds, cross_sections, instrument
+            )
+
+    results = record("analyze", analyze, n_spectra)
+    error = synthetic.retrieval_error(results["fit_curve_values"], injected)
+    return stages, error
+
+
+def parse_scale(scale):
+    n_target, n_pixels = scale.lower().split("x")
+    return int(n_target), int(n_pixels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline")
+    parser.add_argument("--scales", nargs="+", default=["500x1024", "5000x1024"])
+    parser.add_argument("--per_spectrum", type=int, default=50)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="largest median error relative to the peak concentration",
+    )
+    parser.add_argument("--no_asc", action="store_true")
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    report = []
+    failed = False
+    for scale in args.scales:
+        n_target, n_pixels = parse_scale(scale)
+        with tempfile.TemporaryDirectory() as folder:
+            stages, error = run_scale(n_target, n_pixels, Path(folder), args)
+
+        print(f"\n{n_target} target spectra x {n_pixels} pixels")
+        print(
+            f"{'stage':<20} {'spectra':>8} {'time (s)':>10} {'spectra/s':>12} {'peak (MB)':>10}"
+        )
+        for stage in stages:
+            peak = "-" if stage["peak_mb"] is None else f"{stage['peak_mb']:.1f}"
+            print(
+                f"{stage['stage']:<20} {stage['spectra']:>8} {stage['seconds']:>10.3f} "
+                f"{stage['spectra_per_s']:>12.1f} {peak:>10}"
+            )
+
+        ok = error["median"] <= args.tolerance
+        failed |= not ok
+        print(
+            f"concentration error (relative to peak): median {error['median']:.2%}, "
+            f"max {error['max']:.2%} {'OK' if ok else 'FAIL'}"
+        )
+        report.append(
+            {"targets": n_target, "pixels": n_pixels, "stages": stages, "error": error}
+        )
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
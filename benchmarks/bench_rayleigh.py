@@ -0,0 +1,71 @@
+# Compares the vectorized, cached rayleigh.Rayleigh_N2 against the original
+# per-wavelength loop for equivalence and speed.
+#
+#   python benchmarks/bench_rayleigh.py [n_points ...]
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bbceas_processing import rayleigh
+
+
+# The array branch of Rayleigh_N2 before it was vectorized.
+def rayleigh_n2_loop(wl):
+    wn = (wl * 1e-7) ** -1
+    wl_E = wn**-1
+
+    XS = np.empty_like(wl)
+    for i, x in enumerate(wn):
+        if 21360 < x:
+            RI_2 = 318.81874e12 / (14.4e9 - x**2)
+            RI = (5677.465 + RI_2) / 1e8 + 1
+        else:
+            RI_2 = 307.43305e12 / (14.4e9 - x**2)
+            RI = (6498.2 + RI_2) / 1e8 + 1
+
+        XSA = 8 * np.pi**3 / wl_E[i:] ** 4 / (2.546899e19) ** 2 / 3
+        XSB = (RI**2 - 1) ** 2
+        Fk = 1.034 + 3.17e-12 * x**2
+        XS[i:] = XSA * XSB * Fk
+    return XS
+
+
+def main(sizes):
+    print(f"{'points':>8} {'loop (ms)':>12} {'vector (ms)':>12} {'cached (ms)':>12}")
+    for n_points in sizes:
+        # Spans both refractive-index branches (21360 cm^-1 is ~468 nm).
+        wl = np.linspace(250, 700, n_points)
+
+        expected = rayleigh_n2_loop(wl)
+        rayleigh.clear_cache()
+        actual = rayleigh.Rayleigh_N2(wl)
+        if not np.allclose(actual, expected, rtol=1e-12, atol=0):
+            raise AssertionError(
+                f"Rayleigh_N2 differs from the loop for {n_points} points"
+            )
+
+        for scalar in (float(wl[0]), float(wl[-1])):
+            assert np.isclose(rayleigh.Rayleigh_N2(scalar), expected[wl == scalar][0])
+
+        repeat = 5
+        loop = timeit.timeit(lambda: rayleigh_n2_loop(wl), number=repeat) / repeat
+
+        def uncached():
+            rayleigh.clear_cache()
+            rayleigh.Rayleigh_N2(wl)
+
+        vector = timeit.timeit(uncached, number=repeat) / repeat
+        rayleigh.Rayleigh_N2(wl)
+        cached = timeit.timeit(lambda: rayleigh.Rayleigh_N2(wl), number=repeat) / repeat
+
+        print(
+            f"{n_points:>8} {loop * 1e3:>12.3f} {vector * 1e3:>12.3f} {cached * 1e3:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [200, 2048, 8192])
@@ -0,0 +1,76 @@
+# Measures how long main.py takes to start and checks that the plotting and web
+# stacks are not imported until a command needs them.
+#
+#   python benchmarks/bench_startup.py [--repeat 5] [--max_seconds 2.0]
+#
+# Exits with an error if a heavy module is imported with main.py, or if the median
+# start-up time of any command is above --max_seconds.
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY = ["dash", "flask", "matplotlib", "plotly", "lmfit", "scipy"]
+COMMANDS = [["--help"], ["analyze", "--help"], ["import", "--help"]]
+
+
+def start_up_time(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            cwd=ROOT,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def imported_heavy_modules():
+    code = (
+        "import sys; import main; "
+        f"print(' '.join(name for name in {HEAVY!r} if name in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    )
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI start-up")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max_seconds", type=float)
+    args = parser.parse_args()
+
+    failed = False
+    heavy = imported_heavy_modules()
+    if heavy:
+        print(f"main.py imports {', '.join(heavy)} at start-up")
+        failed = True
+
+    baseline = start_up_time(["-c", "pass"], args.repeat)
+    print(f"{'command':<24} {'median (s)':>10}")
+    print(f"{'python -c pass':<24} {baseline:>10.3f}")
+    for command in COMMANDS:
+        elapsed = start_up_time(["main.py", *command], args.repeat)
+        print(f"{'main.py ' + ' '.join(command):<24} {elapsed:>10.3f}")
+        if args.max_seconds is not None and elapsed > args.max_seconds:
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
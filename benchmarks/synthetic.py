@@ -0,0 +1,201 @@
+# Synthetic closed-cavity BBCEAS datasets for the benchmarks: a dark window, N2 and
+# He calibration windows and a target window in which the gases' concentrations
+# vary over time, built with the same cavity model bbceas_processing inverts.
+#
+#   python benchmarks/synthetic.py OUT_FOLDER [--targets N] [--pixels N] ...
+#
+# writes OUT_FOLDER/asc (one .asc file per spectrum), OUT_FOLDER/dataset (an
+# imported dataset), the cross-sections (xs_<i>.csv), bounds.json and the injected
+# concentrations (concentrations.csv).
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from bbceas_processing import closed_cavity_data
+from bbceas_processing import dataset
+from bbceas_processing import prepare
+from bbceas_processing import rayleigh
+
+START = pd.Timestamp("2022-05-01T00:00:00Z")
+
+
+# Band-like absorption cross-sections (cm^2) on wavelengths, one per gas, with
+# vibronic structure inside the 306-312 nm fit window like SO2 or OH.
+def synthetic_cross_sections(wavelengths, n_gases=2, peak=1e-19):
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    cross_sections = []
+    for i in range(n_gases):
+        bands = 1 + np.sin(2 * np.pi * (wavelengths - 300) / (0.9 + 0.35 * i) + i)
+        envelope = np.exp(-((wavelengths - 309 - i) ** 2) / 60)
+        cross_sections.append(
+            pd.DataFrame({1: peak * bands * envelope}, index=pd.Index(wavelengths))
+        )
+    return cross_sections
+
+
+# Returns samples (timestamps x wavelengths, raw counts), the bounds of each
+# window, the cross-sections on the instrument grid and the injected
+# concentrations (molecules/cm^3, one column per gas) of the target window.
+#
+# concentrations gives each gas's peak concentration; within the target window
+# they follow slow, out-of-phase sinusoids. cross_sections (list of Series or
+# single-column DataFrames indexed by wavelength, e.g. read from CSV) are
+# interpolated onto the grid; by default synthetic ones are used. noise scales the
+# shot and read noise (0 for noiseless spectra).
+def generate(
+    n_target=1000,
+    n_pixels=1024,
+    concentrations=(2e12, 5e11),
+    cross_sections=None,
+    n_calibration=60,
+    noise=1.0,
+    seed=0,
+    period="1s",
+):
+    rng = np.random.default_rng(seed)
+    wavelengths = np.linspace(295, 325, n_pixels)
+    if cross_sections is None:
+        cross_sections = synthetic_cross_sections(wavelengths, len(concentrations))
+    matrix = prepare.align_cross_sections(cross_sections, wavelengths).to_numpy()
+    if matrix.shape[1] != len(concentrations):
+        raise ValueError("Need one concentration per cross-section")
+
+    # Lamp (an LED with a little etalon ripple) seen through the cavity filled
+    # with He; N2 scatters more, so less light gets through.
+    lamp = 4e4 * np.exp(-((wavelengths - 310) ** 2) / 120)
+    lamp *= 1 + 0.02 * np.sin(wavelengths * 7)
+    reflectivity = 0.99955 - 2e-6 * (wavelengths - 310) ** 2
+    density = rayleigh.Density_calc(pressure=620, temp_K=298)
+    loss = (1 - reflectivity) / closed_cavity_data.CAVITY_LENGTH
+    He = lamp
+    N2 = (
+        He
+        * (loss + density * rayleigh.Rayleigh_He(wavelengths))
+        / (loss + density * rayleigh.Rayleigh_N2(wavelengths))
+    )
+    dark = 950 + 30 * np.sin(wavelengths / 3)
+
+    # Target: sample air with the gases and a broadband (aerosol-like) extinction.
+    phase = np.arange(n_target) / max(n_target, 1)
+    injected = np.column_stack(
+        [
+            peak * (0.55 + 0.45 * np.sin(2 * np.pi * (3 * phase + i / 4)))
+            for i, peak in enumerate(concentrations)
+        ]
+    )
+    broadband = 2e-9 + 1e-10 * (wavelengths - 310) + 5e-12 * (wavelengths - 310) ** 2
+    absorption = injected @ matrix.T + broadband
+    extinction = loss + density * rayleigh.Rayleigh_Air(wavelengths)
+    target = N2 / (1 + absorption / extinction)
+
+    counts = np.vstack(
+        [
+            np.zeros((n_calibration, n_pixels)),
+            np.broadcast_to(N2, (n_calibration, n_pixels)),
+            np.broadcast_to(He, (n_calibration, n_pixels)),
+            target,
+        ]
+    )
+    if noise:
+        shot = np.sqrt(counts) * rng.standard_normal(counts.shape)
+        read = 8 * rng.standard_normal(counts.shape)
+        counts = counts + noise * (shot + read)
+    counts += dark
+
+    index = pd.date_range(START, periods=len(counts), freq=period)
+    samples = pd.DataFrame(counts, index=index, columns=wavelengths)
+
+    # Window edges are excluded, so each window is widened by half a period.
+    half = pd.Timedelta(period) / 2
+    bounds = {}
+    for i, key in enumerate(["dark", "N2", "He"]):
+        window = index[i * n_calibration : (i + 1) * n_calibration]
+        bounds[key] = [(window[0] - half).isoformat(), (window[-1] + half).isoformat()]
+    window = index[3 * n_calibration :]
+    bounds["target"] = [(window[0] - half).isoformat(), (window[-1] + half).isoformat()]
+
+    cross_sections = [
+        pd.DataFrame({1: matrix[:, i]}, index=pd.Index(wavelengths))
+        for i in range(matrix.shape[1])
+    ]
+    injected = pd.DataFrame(injected, index=window)
+    return samples, bounds, cross_sections, injected
+
+
+# Writes samples as .asc files in the spectrometer's format (a timestamp line,
+# the rest of the header, then tab-separated wavelength and counts).
+def write_asc(samples, folder):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    header = "\n".join(f"Header line {i}" for i in range(1, 32))
+    wavelengths = [f"{wavelength:.4f}" for wavelength in samples.columns]
+    for i, (timestamp, row) in enumerate(zip(samples.index, samples.to_numpy())):
+        line = timestamp.strftime("Date and Time: %a %b %-d %H:%M:%S.")
+        line += f"{timestamp.microsecond // 1000:03d}" + timestamp.strftime(" %Y")
+        body = "\n".join(
+            f"{wavelength}\t{value:.3f}" for wavelength, value in zip(wavelengths, row)
+        )
+        (folder / f"spectrum_{i:07d}.asc").write_text(f"{line}\n{header}\n{body}\n")
+
+
+# How far the retrieved concentrations (fit_curve_values, one column per gas
+# first) are from the injected ones: the median and largest error relative to
+# each gas's peak concentration.
+def retrieval_error(fit_curve_values, injected):
+    retrieved = fit_curve_values.loc[injected.index, list(injected.columns)]
+    error = (retrieved - injected).abs() / injected.max()
+    return {
+        "median": float(np.nanmedian(error.to_numpy())),
+        "max": float(np.nanmax(error.to_numpy())),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic BBCEAS dataset")
+    parser.add_argument("out_folder", type=Path)
+    parser.add_argument("--targets", type=int, default=1000)
+    parser.add_argument("--pixels", type=int, default=1024)
+    parser.add_argument("--concentrations", type=float, nargs="+", default=[2e12, 5e11])
+    parser.add_argument(
+        "-c",
+        "--cross_sections",
+        type=Path,
+        nargs="+",
+        help="cross-section CSVs (wavelength, cm^2); synthetic ones by default",
+    )
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_asc", action="store_true")
+    args = parser.parse_args()
+
+    cross_sections = None
+    if args.cross_sections:
+        cross_sections = prepare.read_cross_sections(args.cross_sections)
+    samples, bounds, cross_sections, injected = generate(
+        n_target=args.targets,
+        n_pixels=args.pixels,
+        concentrations=args.concentrations,
+        cross_sections=cross_sections,
+        noise=args.noise,
+        seed=args.seed,
+    )
+
+    out_folder = args.out_folder
+    out_folder.mkdir(parents=True, exist_ok=True)
+    if not args.no_asc:
+        write_asc(samples, out_folder / "asc")
+    dataset.write(samples, out_folder / "dataset")
+    for i, section in enumerate(cross_sections):
+        section.to_csv(out_folder / f"xs_{i}.csv", header=False)
+    (out_folder / "bounds.json").write_text(json.dumps(bounds))
+    injected.to_csv(out_folder / "concentrations.csv")
+
+
+if __name__ == "__main__":
+    main()
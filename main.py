@@ -1,21 +1,29 @@
-from audioop import cross
-from email import header
-from email.policy import default
 import json
 from pathlib import Path
 
-import arrow
 import click
-import dash
-from dash import dcc, html, Input, Output
-from flask import request
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
 import pandas as pd
-import plotly.express as px
 
 import bbceas_processing
 
+# The plotting and web stacks (matplotlib, dash, plotly, flask) are imported by the
+# functions that use them, so commands that do not plot or open the bounds picker
+# start quickly.
+
+# The analyze options that --chunk cannot be combined with: it always writes its
+# results as it goes, reads the dataset in its stored dtype and does not cache,
+# load or profile the calibration.
+CHUNK_UNSUPPORTED = {
+    "stream",
+    "window",
+    "calibration_cache",
+    "calibration_name",
+    "save_calibration",
+    "profile",
+    "dtype",
+    "auto_bounds",
+}
+
 
 @click.group()
 def cli():
@@ -23,7 +31,7 @@ def cli():
 
 
 @cli.command()
-@click.argument("in_data", type=click.File())
+@click.argument("in_data", type=click.Path(exists=True))
 @click.option("-c", "--cross_sections_in", type=click.File(), multiple=True)
 # @click.argument("cross_sections_2", type=click.File())
 @click.argument("out_folder", type=click.Path(dir_okay=True, file_okay=False))
@@ -34,81 +42,423 @@ def cli():
     default="closed-cavity",
 )
 @click.option("-b", "--bounds_file", type=click.File())
-def analyze(in_data, cross_sections_in, out_folder, instrument_type, bounds_file):
-    # Load data
-    in_data = pd.read_pickle(in_data.name)
-
-    # Load in cross sections
-    cross_sections = []
-    for file in cross_sections_in:
-        cross_sections.append(pd.read_csv(file, header=None, index_col=0))
-
-    # Take the wavelengths from the cross-sections before sending to bounds picker
-    in_data.columns = cross_sections[0].index
+@click.option("--stream", is_flag=True)
+@click.option("--window", type=int, default=1000)
+@click.option("--chunk")
+@click.option(
+    "--calibration_cache",
+    type=click.Path(file_okay=False),
+    default=str(bbceas_processing.calibration.DEFAULT_FOLDER),
+)
+@click.option("--calibration", "calibration_name")
+@click.option("--save_calibration")
+@click.option("--profile", is_flag=True)
+@click.option("--no-plots", "no_plots", is_flag=True)
+@click.option("--average")
+@click.option("--dtype", type=click.Choice(["float32", "float64"]))
+@click.option("--windows", "windows_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--time_resolved", is_flag=True)
+@click.option("--housekeeping", "housekeeping_file", type=click.Path(exists=True))
+@click.option("--housekeeping_tolerance")
+@click.option("--auto_bounds", is_flag=True)
+@click.option("--max_calibration", default="10min")
+@click.option(
+    "--fit_method", type=click.Choice(["linear", "lm", "shift"]), default="linear"
+)
+def analyze(
+    in_data,
+    cross_sections_in,
+    out_folder,
+    instrument_type,
+    bounds_file,
+    stream,
+    window,
+    chunk,
+    calibration_cache,
+    calibration_name,
+    save_calibration,
+    profile,
+    no_plots,
+    average,
+    dtype,
+    windows_file,
+    time_resolved,
+    housekeeping_file,
+    housekeeping_tolerance,
+    auto_bounds,
+    max_calibration,
+    fit_method,
+):
+    # Interpolate the cross-sections onto the instrument's wavelengths in the fit
+    # window, or in each window of --windows (cached, so repeated analyses skip
+    # reading the CSVs). wavelengths covers every window.
+    in_path = in_data
+    grid = bbceas_processing.dataset.wavelengths(in_path)
+    if windows_file is None:
+        windows = None
+        wavelengths = bbceas_processing.prepare.fit_wavelengths(grid)
+        cross_sections = bbceas_processing.prepare.cross_section_matrix(
+            [file.name for file in cross_sections_in], wavelengths
+        )
+        picker_wavelengths = wavelengths
+    else:
+        windows = bbceas_processing.prepare.read_windows(windows_file, grid)
+        wavelengths, fitted = bbceas_processing.prepare.fit_windows(grid, windows)
+        cross_sections = None
+        picker_wavelengths = fitted[0]["wavelengths"]
+
+    # With --time_resolved every calibration window gets its own reflectivity.
+    options = {}
+    if time_resolved:
+        if instrument_type != "closed-cavity":
+            raise click.UsageError("--time_resolved needs a closed-cavity instrument")
+        options["time_resolved"] = True
+    instrument = get_instrument(instrument_type, **options)
+
+    # With --housekeeping the gas densities follow the logged pressure and
+    # temperature. The log is part of the calibration cache key.
+    key_options = dict(options)
+    if housekeeping_file is not None:
+        instrument.set_housekeeping(
+            bbceas_processing.housekeeping.read_housekeeping(housekeeping_file),
+            housekeeping_tolerance,
+        )
+        key_options["housekeeping"] = bbceas_processing.calibration.dataset_identity(
+            housekeeping_file
+        )
+        key_options["housekeeping_tolerance"] = housekeeping_tolerance
+
+    if chunk is not None:
+        # Out-of-core: read and fit the target window one time chunk at a time and
+        # write every result to out_folder as it is done.
+        if bounds_file is None:
+            raise click.UsageError("--chunk requires a bounds file")
+        if windows is not None:
+            raise click.UsageError("--chunk only fits the default window")
+        if fit_method != "linear":
+            raise click.UsageError("--chunk only fits with the linear method")
+        # Options of the in-memory path that the chunked one has no use for.
+        context = click.get_current_context()
+        for param in context.command.params:
+            if param.name in CHUNK_UNSUPPORTED and (
+                context.get_parameter_source(param.name)
+                != click.core.ParameterSource.DEFAULT
+            ):
+                raise click.UsageError(f"--chunk does not support {param.opts[0]}")
+        processed_data = bbceas_processing.chunked.analyze_chunked(
+            in_data,
+            json.load(bounds_file),
+            cross_sections,
+            instrument,
+            bbceas_processing.writers.CsvWriter(out_folder),
+            chunk=chunk,
+            average=average,
+        )
+        save_data(processed_data, out_folder, plots=not no_plots)
+        return
+
+    # Calibrations are cached by dataset, calibration windows, wavelengths and
+    # instrument, or taken from a calibration saved under a name.
+    cache = bbceas_processing.calibration.CalibrationCache(calibration_cache)
+    if calibration_name is not None:
+        calibration = cache.load(calibration_name)
+    else:
+        calibration = None
 
+    # Load data. Only the fit window is read and, with a bounds file, only the time
+    # range the bounds cover, or just the target window when the calibration is
+    # already known. Intensities keep the dataset's dtype unless --dtype is given.
+    low, high = wavelengths[0], wavelengths[-1]
     if bounds_file is None:
-        # Pick a specific wavelength for the bounds picker to display
-        wavelengths = in_data.columns
-        selected_wavelength = wavelengths[(wavelengths > 308) & (wavelengths < 312)][0]
-        bounds = run_bounds_picker(in_data[selected_wavelength], instrument_type)
-        print(bounds)
+        in_data = bbceas_processing.dataset.load(
+            in_path, low=low, high=high, dtype=dtype
+        )
     else:
         bounds = json.load(bounds_file)
+        if calibration is None:
+            key = cache.key(in_path, bounds, wavelengths, instrument_type, key_options)
+            calibration = cache.get(key)
+        keys = None if calibration is None else ["target"]
+        start, end = bbceas_processing.utils.bounds_span(bounds, keys)
+        in_data = bbceas_processing.dataset.load(
+            in_path, start=start, end=end, low=low, high=high, dtype=dtype
+        )
 
-    if instrument_type == "closed-cavity":
-        instrument = bbceas_processing.closed_cavity_data.ClosedCavityData()
-    elif instrument_type == "open-cavity":
-        instrument = bbceas_processing.open_cavity_data.OpenCavityData()
+    if bounds_file is None and auto_bounds:
+        # Unattended: find the phases and keep the bounds next to the results.
+        bounds = detect_bounds(in_data, instrument_type, max_calibration)
+        Path(out_folder).mkdir(parents=True, exist_ok=True)
+        (Path(out_folder) / "bounds.json").write_text(json.dumps(bounds, indent=2))
+        if calibration is None:
+            key = cache.key(in_path, bounds, wavelengths, instrument_type, key_options)
+            calibration = cache.get(key)
+    elif bounds_file is None:
+        # The bounds picker shows the middle wavelength of the (first) fit window.
+        selected_wavelength = picker_wavelengths[len(picker_wavelengths) // 2]
+        bounds = run_bounds_picker(in_data, selected_wavelength, instrument_type)
+        print(bounds)
+        if calibration is None:
+            key = cache.key(in_path, bounds, wavelengths, instrument_type, key_options)
+            calibration = cache.get(key)
+
+    # Stream the per-timestamp results to CSV files instead of holding them in memory.
+    writer = bbceas_processing.writers.CsvWriter(out_folder) if stream else None
+
+    # With --profile the time and memory of each stage go to profile.json.
+    if profile:
+        profiler = bbceas_processing.profiling.Profiler()
+    else:
+        profiler = bbceas_processing.profiling.NULL
 
     processed_data = bbceas_processing.analyze(
-        in_data, bounds, cross_sections, instrument
+        in_data,
+        bounds,
+        cross_sections,
+        instrument,
+        fit_method=fit_method,
+        writer=writer,
+        window=window,
+        calibration=calibration,
+        average=average,
+        profiler=profiler,
+        windows=windows,
     )
     print(processed_data)
 
-    save_data(processed_data, out_folder)
+    if calibration is None:
+        cache.put(key, processed_data["calibration"])
+    if save_calibration is not None:
+        cache.save(save_calibration, processed_data["calibration"])
+
+    with profiler.stage("save"):
+        save_data(processed_data, out_folder, plots=not no_plots)
+
+    if profile:
+        profiler.close()
+        profiler.write(Path(out_folder) / "profile.json")
 
 
 @cli.command(name="import")
 @click.argument(
     "in_folder", type=click.Path(exists=True, dir_okay=True, file_okay=False)
 )
-@click.argument("out_data", type=click.Path(file_okay=True, dir_okay=False))
+@click.argument("out_data", type=click.Path())
 @click.option(
     "--format", type=click.Choice(["asc"], case_sensitive=False), default="asc"
 )
-def import_data(in_folder, out_data, format):
-    if format == "asc":
-        data = bbceas_processing.utils.process_asc(in_folder)
-    else:
+@click.option("-j", "--workers", type=int)
+@click.option("--incremental", is_flag=True)
+@click.option("--dtype", type=click.Choice(["float32", "float64"]), default="float32")
+def import_data(in_folder, out_data, format, workers, incremental, dtype):
+    if format != "asc":
         print(f"Unknown format: {format}")
         exit(1)
 
-    data = data.sort_index()
-    data.to_pickle(out_data)
+    if incremental:
+        # OUT_DATA is a dataset folder; only new or changed files are parsed.
+        files = bbceas_processing.dataset.changed_files(in_folder, out_data)
+        n_files = len(files)
+    else:
+        n_files = sum(1 for file in Path(in_folder).iterdir() if file.suffix == ".asc")
+    with click.progressbar(length=n_files, label="Importing") as bar:
+        if incremental:
+            result = bbceas_processing.dataset.import_asc_incremental(
+                in_folder,
+                out_data,
+                workers=workers,
+                progress=bar.update,
+                dtype=dtype,
+                files=files,
+            )
+        else:
+            data = bbceas_processing.utils.process_asc(
+                in_folder, workers=workers, progress=bar.update, dtype=dtype
+            )
+
+    if incremental:
+        print(
+            f"Imported {result['read']} new or changed files, "
+            f"skipped {len(result['duplicates'])} duplicate timestamps"
+        )
+        return
+
+    bbceas_processing.dataset.write(data, out_data, dtype=dtype)
+
+
+@cli.command()
+@click.argument(
+    "in_folder", type=click.Path(exists=True, dir_okay=True, file_okay=False)
+)
+@click.argument("out_folder", type=click.Path(dir_okay=True, file_okay=False))
+@click.option("--calibration_data", type=click.Path(exists=True), required=True)
+@click.option("-c", "--cross_sections_in", type=click.File(), multiple=True)
+@click.option(
+    "-i",
+    "--instrument_type",
+    type=click.Choice(["open-cavity", "closed-cavity"], case_sensitive=False),
+    default="closed-cavity",
+)
+@click.option("-b", "--bounds_file", type=click.File(), required=True)
+@click.option("--interval", type=float, default=0.5)
+def stream(
+    in_folder,
+    out_folder,
+    calibration_data,
+    cross_sections_in,
+    instrument_type,
+    bounds_file,
+    interval,
+):
+    wavelengths = bbceas_processing.prepare.fit_wavelengths(
+        bbceas_processing.dataset.wavelengths(calibration_data)
+    )
+    cross_sections = bbceas_processing.prepare.cross_section_matrix(
+        [file.name for file in cross_sections_in], wavelengths
+    )
+
+    # The calibration windows (dark, N2/He or ambient/with-optic) come from an
+    # imported dataset; any target window in the bounds file is ignored.
+    bounds = json.load(bounds_file)
+    bounds.pop("target", None)
+    start, end = bbceas_processing.utils.bounds_span(bounds)
+    samples = bbceas_processing.dataset.load(calibration_data, start=start, end=end)
+
+    instrument = get_instrument(instrument_type)
+
+    analyzer = bbceas_processing.stream.StreamAnalyzer(
+        samples, bounds, cross_sections, instrument
+    )
+    writer = bbceas_processing.writers.CsvWriter(out_folder, append=True)
+    bbceas_processing.stream.watch(in_folder, analyzer, writer, interval=interval)
+
+
+@cli.command()
+@click.argument("in_data", type=click.Path(exists=True))
+@click.argument("bounds_file", type=click.Path(dir_okay=False))
+@click.option(
+    "-i",
+    "--instrument_type",
+    type=click.Choice(["open-cavity", "closed-cavity"], case_sensitive=False),
+    default="closed-cavity",
+)
+@click.option("--max_calibration", default="10min")
+def phases(in_data, bounds_file, instrument_type, max_calibration):
+    # Finds the dark, calibration and target periods of a dataset (its fit window)
+    # and writes them to BOUNDS_FILE for analyze -b.
+    wavelengths = bbceas_processing.prepare.fit_wavelengths(
+        bbceas_processing.dataset.wavelengths(in_data)
+    )
+    data = bbceas_processing.dataset.load(
+        in_data, low=wavelengths[0], high=wavelengths[-1]
+    )
+    bounds = detect_bounds(data, instrument_type, max_calibration)
+    Path(bounds_file).write_text(json.dumps(bounds, indent=2))
+
+
+@cli.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.argument("out_folder", type=click.Path(dir_okay=True, file_okay=False))
+@click.option("-c", "--cross_sections_in", type=click.File(), multiple=True)
+@click.option("-j", "--workers", type=int)
+@click.option("--window", type=int, default=1000)
+def batch(manifest, out_folder, cross_sections_in, workers, window):
+    # MANIFEST is a CSV with dataset, bounds and optionally instrument and output
+    # columns. Every job is analyzed with the same cross-sections.
+    jobs = bbceas_processing.batch.read_manifest(manifest, out_folder)
+
+    def report(summary):
+        print(
+            f"{summary['status']:>6} {summary['dataset']}"
+            + (f": {summary['error']}" if summary["error"] else "")
+        )
+
+    summary = bbceas_processing.batch.run_batch(
+        jobs,
+        [file.name for file in cross_sections_in],
+        workers=workers,
+        window=window,
+        report=report,
+    )
+
+    Path(out_folder).mkdir(parents=True, exist_ok=True)
+    summary.to_csv(Path(out_folder) / "summary.csv", index=False)
+    print(summary.drop(columns=["output", "error"]).to_string(index=False))
+    if (summary["status"] != "ok").any():
+        exit(1)
+
+
+def get_instrument(instrument_type, **options):
+    return bbceas_processing.instruments.get_instrument(instrument_type, **options)
+
+
+# Finds the phases of data for the instrument's calibration keys, prints them and
+# returns them as bounds.
+def detect_bounds(data, instrument_type, max_calibration):
+    instrument = bbceas_processing.instruments.instrument_class(instrument_type)
+    levels = instrument.phase_levels
+    segments = bbceas_processing.phases.detect_phases(
+        data, levels, max_calibration=max_calibration
+    )
+    print(segments.to_string(index=False))
+    return bbceas_processing.phases.to_bounds(
+        segments,
+        [*levels, "target"],
+        bbceas_processing.phases.sampling_period(data),
+    )
 
 
-def save_data(processed_data, out_folder):
+# Saves the reflectivity and, unless they were already streamed to CSV files, the
+# fit values and their errors, the co-adding counts and standard deviations when
+# spectra were averaged, then the plots unless plots is False. With several fit
+# windows, each window's files are prefixed with its name.
+def save_data(processed_data, out_folder, plots=True):
     out_folder = Path(out_folder)
 
+    processed_data["reflectivity"].to_csv(out_folder / "reflectivity.csv")
+    if processed_data.get("coadd_counts") is not None:
+        processed_data["coadd_counts"].to_csv(out_folder / "coadd_counts.csv")
+        processed_data["coadd_std"].to_csv(out_folder / "coadd_std.csv")
+
+    windows = processed_data.get("windows") or {"default": processed_data}
+    for name, results in windows.items():
+        prefix = f"{name}_" if len(windows) > 1 else ""
+        if results["absorption_all"] is not None:
+            results["fit_curve_values"].to_csv(
+                out_folder / f"{prefix}fit_curve_values.csv"
+            )
+            results["fit_curve_errors"].to_csv(
+                out_folder / f"{prefix}fit_curve_errors.csv"
+            )
+        if plots:
+            save_plots(results, out_folder, prefix)
+
+
+def save_plots(processed_data, out_folder, prefix=""):
+    import matplotlib.pyplot as plt
+    from matplotlib.gridspec import GridSpec
+
     # Save cross section plot
     cross_sections_target = processed_data["cross_sections_target"]
     plt.plot(cross_sections_target.index, cross_sections_target)
-    plt.savefig(out_folder / "cross_sections_target.png")
+    plt.savefig(out_folder / f"{prefix}cross_sections_target.png")
     plt.cla()
 
-
     fitted_data = processed_data["fit_data_highest"]
     absorption = processed_data["absorption_highest"]
     residuals = processed_data["residuals_highest"]
 
-    for i in range(len(processed_data["fit_curve_values"].columns) - 3):
+    # One plot per gas; the polynomial coefficients follow the gases.
+    gases = processed_data.get(
+        "gases", len(processed_data["fit_curve_values"].columns) - 3
+    )
+    for i in range(gases):
         if i == 0:
             title = "concentrations_target.png"
         else:
             title = "concentrations_" + str(i) + ".png"
         concentration = processed_data["fit_curve_values"][i]
         plt.plot(concentration.index, concentration)
-        plt.savefig(out_folder / title)
+        plt.savefig(out_folder / f"{prefix}{title}")
         plt.cla()
 
     fig = plt.figure(constrained_layout=True)
@@ -120,20 +470,72 @@ def save_data(processed_data, out_folder):
     ax1.plot(residuals.index, residuals, ".-")
     ax2.plot(fitted_data.index, fitted_data)
     ax2.plot(absorption.index, absorption)
-    plt.savefig(out_folder / "results.png")
+    plt.savefig(out_folder / f"{prefix}results.png")
     plt.cla()
 
 
-def run_bounds_picker(data, instrument_type):
+# Serves the bounds picker for data (timestamps x wavelengths). The trace of one
+# wavelength is drawn min/max-downsampled to about PICKER_POINTS points and drawn
+# again from the full-resolution data whenever the view is zoomed or panned. A
+# heatmap of the whole dataset at reduced resolution is shown below it. Selected
+# ranges are kept as drawn and the number of raw spectra inside them is counted
+# on the full data, so they are as precise as the raw timestamps.
+PICKER_POINTS = 4000
+
+
+def run_bounds_picker(data, wavelength, instrument_type):
     from collections import defaultdict
 
+    import dash
+    from dash import dcc, html, Input, Output
+    from flask import request
+    import plotly.graph_objects as go
+
+    from bbceas_processing import downsample
+
     bounds = defaultdict(lambda: [None, None])
     app = dash.Dash(__name__)
 
-    fig = px.line(data)
-    fig.update_xaxes(title_text="Time")
-    fig.update_yaxes(title_text="Intensity")
-    fig.update_layout(dragmode="select", hovermode=False)
+    times = data.index
+    values = data[wavelength].to_numpy()
+
+    # The picker shows (and returns) times in the data's time zone, without it.
+    def to_time(edge):
+        return pd.Timestamp(edge).tz_localize(times.tz)
+
+    def trace_figure(start=None, end=None):
+        first = 0 if start is None else times.searchsorted(to_time(start))
+        last = len(times) if end is None else times.searchsorted(to_time(end), "right")
+        # Keep one point either side so the line reaches the edges of the view.
+        first, last = max(first - 1, 0), min(last + 1, len(times))
+        indices = first + downsample.minmax_indices(
+            values[first:last], PICKER_POINTS // 4
+        )
+
+        fig = go.Figure(
+            go.Scattergl(
+                x=times[indices], y=values[indices], mode="lines", name=str(wavelength)
+            )
+        )
+        fig.update_xaxes(title_text="Time")
+        fig.update_yaxes(title_text="Intensity")
+        # uirevision keeps the zoom and selection when the trace is redrawn.
+        fig.update_layout(dragmode="select", hovermode=False, uirevision="picker")
+        if start is not None:
+            fig.update_xaxes(range=[start, end])
+        return fig
+
+    reduced = downsample.overview(data)
+    overview = go.Figure(
+        go.Heatmap(
+            x=reduced.index,
+            y=reduced.columns,
+            z=reduced.to_numpy().T,
+            colorscale="Viridis",
+        )
+    )
+    overview.update_xaxes(title_text="Time")
+    overview.update_yaxes(title_text="Wavelength (nm)")
 
     if instrument_type == "closed-cavity":
         radio_items = dcc.RadioItems(
@@ -159,7 +561,8 @@ def run_bounds_picker(data, instrument_type):
     app.layout = html.Div(
         [
             dcc.Location(id="url", refresh=False),
-            dcc.Graph(id="one-wavelength", figure=fig),
+            dcc.Graph(id="one-wavelength", figure=trace_figure()),
+            dcc.Graph(id="overview", figure=overview),
             html.Br(),
             radio_items,
             html.Div(id="placeholder"),
@@ -171,6 +574,18 @@ def run_bounds_picker(data, instrument_type):
         ]
     )
 
+    @app.callback(
+        Output("one-wavelength", "figure"),
+        Input("one-wavelength", "relayoutData"),
+        prevent_initial_call=True,
+    )
+    def zoom(relayout):
+        if relayout and "xaxis.range[0]" in relayout:
+            return trace_figure(relayout["xaxis.range[0]"], relayout["xaxis.range[1]"])
+        if relayout and "xaxis.autorange" in relayout:
+            return trace_figure()
+        return dash.no_update
+
     @app.callback(
         Output("placeholder", "children"),
         Input("radio-select", "value"),
@@ -205,7 +620,10 @@ def run_bounds_picker(data, instrument_type):
                 bounds["He"][0] = ran[0]
                 bounds["He"][1] = ran[1]
 
-        return ""
+        # Same rule as utils.bound_windows: end points are excluded.
+        start, end = (to_time(edge) for edge in ran)
+        n_spectra = times.searchsorted(end) - times.searchsorted(start, "right")
+        return f"{n_spectra} spectra selected"
 
     def shutdown():
         func = request.environ.get("werkzeug.server.shutdown")